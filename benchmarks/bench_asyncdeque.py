@@ -0,0 +1,86 @@
+'''Compares utils.AsyncDeque with asyncio.Queue, with one producer and one consumer.
+
+    python benchmarks/bench_asyncdeque.py [--items 200000] [--runs 3]
+
+Reports the best of the runs for single item put/get, unbounded and bounded,
+and for batches (put_many/get_many, against Queue's put and get/get_nowait).
+'''
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import AsyncDeque
+
+BATCH = 100
+
+async def single(queue, put, get, items):
+    async def produce():
+        for i in range(items):
+            await put(queue, i)
+    async def consume():
+        for _ in range(items):
+            await get(queue)
+    start = time.perf_counter()
+    await asyncio.gather(produce(), consume())
+    return time.perf_counter() - start
+
+async def queue_batches(items, maxsize):
+    queue = asyncio.Queue(maxsize)
+    async def produce():
+        for i in range(0, items, BATCH):
+            for x in range(i, i + BATCH):
+                await queue.put(x)
+    async def consume():
+        taken = 0
+        while taken < items:
+            batch = [await queue.get()]
+            while len(batch) < BATCH and not queue.empty():
+                batch.append(queue.get_nowait())
+            taken += len(batch)
+    start = time.perf_counter()
+    await asyncio.gather(produce(), consume())
+    return time.perf_counter() - start
+
+async def deque_batches(items, maxsize):
+    queue = AsyncDeque(maxsize)
+    async def produce():
+        for i in range(0, items, BATCH):
+            await queue.put_many(range(i, i + BATCH))
+    async def consume():
+        taken = 0
+        while taken < items:
+            taken += len(await queue.get_many(BATCH))
+    start = time.perf_counter()
+    await asyncio.gather(produce(), consume())
+    return time.perf_counter() - start
+
+async def run(items, runs):
+    cases = [
+        ('put/get, unbounded',
+            lambda: single(asyncio.Queue(), asyncio.Queue.put, asyncio.Queue.get, items),
+            lambda: single(AsyncDeque(), AsyncDeque.put, AsyncDeque.popleft, items)),
+        ('put/get, maxsize=100',
+            lambda: single(asyncio.Queue(100), asyncio.Queue.put, asyncio.Queue.get, items),
+            lambda: single(AsyncDeque(100), AsyncDeque.put, AsyncDeque.popleft, items)),
+        ('batches of {}, maxsize=1000'.format(BATCH),
+            lambda: queue_batches(items, 1000),
+            lambda: deque_batches(items, 1000)),
+    ]
+    print('{} items, best of {} runs'.format(items, runs))
+    for name, queue_case, deque_case in cases:
+        queue_time = min([await queue_case() for _ in range(runs)])
+        deque_time = min([await deque_case() for _ in range(runs)])
+        print('  {:28} Queue {:.3f}s  AsyncDeque {:.3f}s'.format(name, queue_time, deque_time))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=200000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args.items, args.runs))
+
+if __name__ == '__main__':
+    main()
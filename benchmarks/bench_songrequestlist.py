@@ -0,0 +1,107 @@
+'''Measures SongRequestList memory and per operation cost on large queues.
+
+    python benchmarks/bench_songrequestlist.py [--sizes 10000 100000] [--against PATH]
+
+--against loads another songrequestlist.py (like one checked out from an older commit)
+and measures it too. Operations it doesn't have are skipped.
+Requests are stand-ins with the same slots as SongRequest, as that needs discord to import.
+'''
+import argparse
+import importlib.util
+import os
+import random
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CURRENT = os.path.join(HERE, '..', 'plugins', 'musicplayer', 'songrequestlist.py')
+
+class Song:
+    __slots__ = ('title', 'url', 'source', 'duration', 'loudness')
+
+    def __init__(self, title, url):
+        self.title = title
+        self.url = url
+        self.source = None
+        self.duration = None
+        self.loudness = None
+
+class SongRequest:
+    __slots__ = ('song', 'request_user', 'request_channel', 'loop')
+
+    def __init__(self, song, request_user, request_channel):
+        self.song = song
+        self.request_user = request_user
+        self.request_channel = request_channel
+        self.loop = False
+
+def load(path):
+    # Loaded from its file, as importing the plugins package needs the bot's config and dependencies
+    spec = importlib.util.spec_from_file_location('songrequestlist_bench_' + str(abs(hash(path))), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.SongRequestList
+
+def make_requests(count):
+    user, channel = object(), object()
+    return [SongRequest(Song('song {}'.format(i), 'https://example.com/watch?v={:011d}'.format(i)), user, channel)
+        for i in range(count)]
+
+def timed(fn, repeat):
+    "Returns the average seconds of fn() over repeat runs"
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+def bench(SongRequestList, size):
+    results = {}
+
+    tracemalloc.start()
+    requests = make_requests(size)
+    base = tracemalloc.get_traced_memory()[0]
+    queue = SongRequestList()
+    queue.extend(requests)
+    results['memory MB'] = (tracemalloc.get_traced_memory()[0] - base) / 1e6
+    tracemalloc.stop()
+    # What the queue holds besides the requests themselves
+    del requests
+
+    queue.loop = True
+    results['next() us'] = timed(queue.next, 1000) * 1e6
+
+    def restart():
+        # Plays out the cycle outside the timing, then times the next() that restarts it
+        while queue.upcoming if hasattr(queue, 'upcoming') else queue.song_queue:
+            queue.next()
+        start = time.perf_counter()
+        queue.next()
+        return time.perf_counter() - start
+    results['loop restart ms'] = sum(restart() for _ in range(3)) / 3 * 1e3
+    results['shuffle_queue ms'] = timed(queue.shuffle_queue, 10) * 1e3
+
+    if hasattr(queue, 'move'):
+        queue.shuffle = False
+        upcoming = queue.upcoming
+        results['move us'] = timed(lambda: queue.move(random.randrange(upcoming), random.randrange(upcoming)), 1000) * 1e6
+        results['window(page) us'] = timed(lambda: queue.window(random.randrange(upcoming - 10), 10), 1000) * 1e6
+        results['remove_at us'] = timed(lambda: queue.remove_at(random.randrange(queue.upcoming)), 1000) * 1e6
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--against', metavar='PATH', help='another songrequestlist.py to compare with')
+    args = parser.parse_args()
+
+    implementations = [('current', load(CURRENT))]
+    if args.against:
+        implementations.insert(0, ('against', load(args.against)))
+
+    for size in args.sizes:
+        for name, SongRequestList in implementations:
+            results = bench(SongRequestList, size)
+            print('{:>7} {:8} '.format(size, name) + '  '.join('{} {:.2f}'.format(k, v) for k, v in results.items()))
+
+if __name__ == '__main__':
+    main()
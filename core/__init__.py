@@ -1,4 +1,5 @@
-from .tagdatabase import TagDatabase, InvalidTagException
+from .tagdatabase import TagDatabase, AsyncTagDatabase, TagScope, InvalidTagException
+from .cluster import ClusterSupervisor, ClusterClient
 
 def ex_str(ex : Exception):
     "Returns a string that properly represents an exception"
@@ -0,0 +1,295 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+
+class ClusterSupervisor:
+    '''Runs the bot as several worker processes (clusters), each handling some of the shards.
+
+    target is called in each new process as target(cluster_id, shard_ids, shard_count, connection),
+    where connection is the worker's end of a pipe to the supervisor (see ClusterClient).
+    Workers that exit are restarted, waiting longer each time one exits soon after starting.
+
+    The supervisor also relays requests between workers. A broadcast from one
+    worker is sent to every worker, and their replies are returned to it.
+    '''
+
+    # Seconds to wait before restarting a worker, doubled up to max_restart_delay while it keeps crashing
+    restart_delay = 5
+    max_restart_delay = 300
+    # How long a worker has to run for its restart delay to reset
+    stable_after = 60
+    # Discord allows a shard to identify every 5 seconds, so workers start this far apart per shard
+    identify_delay = 5.5
+
+    def __init__(self, target, *, processes, shard_count=None, request_timeout=10):
+        self.target = target
+        self.shard_count = shard_count or processes
+        self.request_timeout = request_timeout
+        self.shards = [list(range(self.shard_count))[i::processes] for i in range(processes)]
+
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = {}
+        self._connections = {}
+        self._started_at = {}
+        self._delays = {}
+        self._restart_at = {}
+        self.restarts = {i: 0 for i in range(processes)}
+        self._stopping = False
+
+        # (origin cluster, request id) -> [cluster ids yet to reply, replies, deadline]
+        self._pending = {}
+
+    def run(self):
+        "Starts the workers, and blocks supervising them until interrupted or terminated"
+        # Stopped by a service manager like Ctrl-C, so that the workers are stopped too
+        previous_handler = signal.signal(signal.SIGTERM, _raise_interrupt)
+
+        start_at = time.monotonic()
+        for cluster_id, shard_ids in enumerate(self.shards):
+            self._restart_at[cluster_id] = start_at
+            start_at += self.identify_delay * len(shard_ids)
+
+        try:
+            while True:
+                self._start_due()
+                self._expire_requests()
+
+                waitables = list(self._connections.values())
+                waitables.extend(p.sentinel for p in self._processes.values())
+                for ready in multiprocessing.connection.wait(waitables, timeout=1):
+                    self._on_ready(ready)
+        except KeyboardInterrupt:
+            logging.info('Stopping the cluster')
+        finally:
+            self._stopping = True
+            for process in self._processes.values():
+                process.terminate()
+            for process in self._processes.values():
+                process.join(10)
+            signal.signal(signal.SIGTERM, previous_handler)
+
+    def status(self):
+        "Returns (cluster id, shard ids, pid or None, restarts) for every worker"
+        result = []
+        for cluster_id, shard_ids in enumerate(self.shards):
+            process = self._processes.get(cluster_id)
+            pid = process.pid if process and process.is_alive() else None
+            result.append((cluster_id, shard_ids, pid, self.restarts[cluster_id]))
+        return result
+
+    def _start_due(self):
+        now = time.monotonic()
+        for cluster_id, start_at in list(self._restart_at.items()):
+            if start_at <= now:
+                del self._restart_at[cluster_id]
+                self._start(cluster_id)
+
+    def _start(self, cluster_id):
+        parent_end, child_end = self._context.Pipe()
+        process = self._context.Process(
+            target=self.target,
+            args=(cluster_id, self.shards[cluster_id], self.shard_count, child_end),
+            name='cluster-{}'.format(cluster_id))
+        process.start()
+        child_end.close()
+
+        self._processes[cluster_id] = process
+        self._connections[cluster_id] = parent_end
+        self._started_at[cluster_id] = time.monotonic()
+        logging.info('Started cluster %d (pid %d) for shards %s', cluster_id, process.pid, self.shards[cluster_id])
+
+    def _on_ready(self, ready):
+        for cluster_id, process in list(self._processes.items()):
+            if ready == process.sentinel:
+                self._on_exit(cluster_id)
+                return
+
+        for cluster_id, connection in list(self._connections.items()):
+            if ready is not connection:
+                continue
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                # The worker is exiting, its sentinel will follow
+                del self._connections[cluster_id]
+                return
+            self._handle(cluster_id, message)
+            return
+
+    def _on_exit(self, cluster_id):
+        process = self._processes.pop(cluster_id)
+        process.join()
+        connection = self._connections.pop(cluster_id, None)
+        if connection:
+            connection.close()
+
+        # Nothing more is coming from it
+        for key in list(self._pending):
+            self._pending[key][0].discard(cluster_id)
+            self._reply_if_done(key)
+        if self._stopping:
+            return
+
+        ran_for = time.monotonic() - self._started_at[cluster_id]
+        delay = self._delays.get(cluster_id, self.restart_delay)
+        if ran_for > self.stable_after:
+            delay = self.restart_delay
+        self._delays[cluster_id] = min(delay * 2, self.max_restart_delay)
+        self._restart_at[cluster_id] = time.monotonic() + delay
+        self.restarts[cluster_id] += 1
+        logging.error('Cluster %d exited with code %s, restarting it in %d seconds',
+            cluster_id, process.exitcode, delay)
+
+    def _handle(self, cluster_id, message):
+        kind = message[0]
+        if kind == 'broadcast':
+            _, request_id, op, payload = message
+            key = (cluster_id, request_id)
+            self._pending[key] = [set(self._connections), [], time.monotonic() + self.request_timeout]
+            for connection in self._connections.values():
+                self._send(connection, ('query', key, op, payload))
+        elif kind == 'reply':
+            _, key, result = message
+            pending = self._pending.get(key)
+            if pending and cluster_id in pending[0]:
+                pending[0].discard(cluster_id)
+                pending[1].append(result)
+                self._reply_if_done(key)
+        elif kind == 'control':
+            _, request_id, op, payload = message
+            self._send(self._connections.get(cluster_id), ('response', request_id, self._control(op, payload)))
+        else:
+            logging.warning('Unknown message %s from cluster %d', kind, cluster_id)
+
+    def _control(self, op, payload):
+        if op == 'status':
+            return self.status()
+        if op == 'restart':
+            process = self._processes.get(payload)
+            if not process:
+                return False
+            # Restarted like after a crash, but without counting against its delay
+            self._delays.pop(payload, None)
+            process.terminate()
+            return True
+        return None
+
+    def _reply_if_done(self, key, force=False):
+        waiting, results, _ = self._pending[key]
+        if waiting and not force:
+            return
+        del self._pending[key]
+        origin, request_id = key
+        self._send(self._connections.get(origin), ('response', request_id, results))
+
+    def _expire_requests(self):
+        now = time.monotonic()
+        for key, (_, _, deadline) in list(self._pending.items()):
+            if deadline <= now:
+                self._reply_if_done(key, force=True)
+
+    def _send(self, connection, message):
+        if not connection:
+            return
+        try:
+            connection.send(message)
+        except (OSError, ValueError):
+            # The worker is exiting, its sentinel will follow
+            pass
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+class ClusterClient:
+    '''A worker's end of the connection to the ClusterSupervisor.
+
+    Handlers registered for an op answer the broadcasts of every worker, including
+    this one. A handler is called with the payload and returns a picklable result,
+    or a coroutine for one. Messages are read on the bot's event loop.
+
+    Requests raise asyncio.TimeoutError if the supervisor doesn't answer within request_timeout.
+    If the connection to the supervisor is lost, on_lost is called, which should stop the
+    worker so that its shards aren't left running beside a new supervisor's.
+    '''
+
+    def __init__(self, cluster_id, shard_ids, connection, *, request_timeout=30):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.request_timeout = request_timeout
+        self._connection = connection
+        self._handlers = {}
+        self._pending = {}
+        self._ids = itertools.count()
+        self._loop = None
+        self._on_lost = None
+
+    def start(self, loop, *, on_lost=None):
+        '''Starts handling messages on the event loop.
+        on_lost is called (or awaited, if it returns a coroutine) once the supervisor is gone'''
+        self._loop = loop
+        self._on_lost = on_lost
+        loop.add_reader(self._connection.fileno(), self._on_readable)
+
+    def register(self, op, handler):
+        "Sets the handler that answers broadcasts of op"
+        self._handlers[op] = handler
+
+    async def broadcast(self, op, payload=None):
+        '''This is a coroutine. Sends a request to every worker and returns their replies.
+        Workers that don't reply in time (or are restarting) are missing from them'''
+        return await self._request('broadcast', op, payload)
+
+    async def control(self, op, payload=None):
+        '''This is a coroutine. Sends a request to the supervisor itself and returns its reply.
+        The ops are 'status', and 'restart' with a cluster id'''
+        return await self._request('control', op, payload)
+
+    async def _request(self, kind, op, payload):
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self._pending[request_id] = future
+        try:
+            self._connection.send((kind, request_id, op, payload))
+            return await asyncio.wait_for(future, self.request_timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def _on_readable(self):
+        try:
+            while self._connection.poll():
+                self._dispatch(self._connection.recv())
+        except (EOFError, OSError):
+            logging.error('Lost the connection to the cluster supervisor')
+            self._loop.remove_reader(self._connection.fileno())
+            if self._on_lost:
+                result = self._on_lost()
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+
+    def _dispatch(self, message):
+        kind = message[0]
+        if kind == 'query':
+            _, key, op, payload = message
+            asyncio.ensure_future(self._answer(key, op, payload))
+        elif kind == 'response':
+            _, request_id, result = message
+            future = self._pending.get(request_id)
+            if future and not future.done():
+                future.set_result(result)
+
+    async def _answer(self, key, op, payload):
+        result = None
+        handler = self._handlers.get(op)
+        try:
+            if handler:
+                result = handler(payload)
+                if asyncio.iscoroutine(result):
+                    result = await result
+        except Exception:
+            logging.exception('Could not answer %s for the cluster', op)
+            result = None
+        self._connection.send(('reply', key, result))
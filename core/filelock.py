@@ -0,0 +1,20 @@
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (windows) there is no locking, which is fine for a single process
+    fcntl = None
+
+@contextlib.contextmanager
+def locked(path):
+    '''Holds an exclusive lock on path while in the with block, shared between processes.
+    The lock is taken on a separate path + '.lock' file, so path itself can be replaced'''
+    with open(path + '.lock', 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,41 +1,468 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import enum
+import functools
+import glob
+import logging
 import shelve
+import sqlite3
+import threading
+import time
 
 class InvalidTagException(Exception):
     pass
 
+class TagScope(enum.IntEnum):
+    "Who a tag belongs to. Tags are looked up in this order"
+    USER = 0
+    GUILD = 1
+    GLOBAL = 2
+
+# Cached for tags that don't exist, as most lookups are for urls that aren't tags
+_MISSING = object()
+
+def trigrams(name):
+    "Returns the set of trigrams of a tag name for fuzzy matching. Its padded, so that short names have some too"
+    padded = '  {} '.format(name.lower())
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
 class TagDatabase:
-    '''A class used to store and retrieve tags for individual users'''
+    '''A class used to store and retrieve tags for users, guilds, or everyone.
+
+    Tags are rows of a SQLite table keyed by (scope, owner, name), on a connection
+    kept open in WAL mode, so that readers don't wait on writers (even in other
+    processes). Reads go through a LRU cache, which is dropped whenever another
+    connection commits. Every write is its own transaction, unless its made in
+    a batch() block, which commits them all at once.
+
+    Names can be completed by prefix, using the table's own index, and misspelled
+    names matched through an index of their trigrams.
+
+    The schema version is kept in PRAGMA user_version, and older databases are
+    migrated when opened. Tags from the old shelve database are copied over once.
+    '''
+
+    # How similar (in shared trigrams) a name has to be to be suggested
+    min_similarity = 0.3
+
+    def __init__(self, path='database/tags.db', *, cache_size=10000, legacy_path='database/tag.sdb'):
+        self.path = path
+        self.cache_size = cache_size
+
+        self._cache = collections.OrderedDict()
+        self._checked_at = 0
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._migrate()
+        self._migrate_shelve(legacy_path)
+        self._data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+
     def _validate_tagname(self, name):
         if len(name) > 50:
             raise InvalidTagException('Tag too long')
 
     def set(self, user_id, name, value):
+        "Sets a tag for that user"
+        self.set_scoped(TagScope.USER, user_id, name, value)
+
+    def set_scoped(self, scope, owner_id, name, value):
+        "Sets a tag in a scope. owner_id is the user or guild id, and is ignored for GLOBAL"
         self._validate_tagname(name)
-        with shelve.open('database/tag.sdb') as s:
-            userkey = 'user_{}'.format(user_id)
-            data = s.get(userkey, {})
-            data[name] = value
-            s[userkey] = data
+        owner_id = self._owner(scope, owner_id)
+        with self.batch():
+            self._insert(scope, owner_id, name, value)
+            self._cache_put((scope, owner_id, name), value)
 
     def get(self, user_id, name):
         'gets the tag identified by the name for that user. Raises KeyError if does not exist'
         self._validate_tagname(name)
-        with shelve.open('database/tag.sdb') as s:
-            data = s.get('user_{}'.format(user_id), {})
-            return data[name]
+        value = self._lookup(TagScope.USER, user_id, name)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
 
-    def try_get(self, user_id, name, default=None):
+    def resolve(self, user_id, guild_id, name):
+        '''Gets the tag identified by name, looking at the user's tags, then the guild's
+        (unless guild_id is None), then the global ones. Raises KeyError if none have it'''
+        self._validate_tagname(name)
+        for scope, owner_id in self.owners(user_id, guild_id):
+            value = self._lookup(scope, owner_id, name)
+            if value is not _MISSING:
+                return value
+        raise KeyError(name)
+
+    def try_get(self, user_id, name, default=None, *, guild_id=None):
         '''Gets the tag identified by name for that user, returning default if it doesn't exist.
+        If a guild_id is given, the guild's and global tags are looked at as well, like resolve().
         It can still throw data related errors'''
         try:
-            return self.get(user_id, name)
+            return self.resolve(user_id, guild_id, name)
         except KeyError:
             return default
         except InvalidTagException:
             return default
 
+    def peek(self, scope, owner_id, name, max_age):
+        '''Returns the tag from the cache, without touching the database or waiting on it.
+        Returns None if its not cached, or if the cache wasn't checked for changes made
+        by other connections within max_age seconds. Raises KeyError if the tag is known
+        not to exist. Unlike the rest, this can be called while another thread uses the database'''
+        if time.monotonic() - self._checked_at > max_age:
+            return None
+        value = self._cache.get((scope, self._owner(scope, owner_id), name))
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
     def keys_for(self, user_id):
         '''Shows all tags belonging to that user'''
-        with shelve.open('database/tag.sdb') as s:
-            data = s.get('user_{}'.format(user_id), {})
-            return data.keys()
+        return self.names(TagScope.USER, user_id)
+
+    def names(self, scope, owner_id):
+        "Returns the names of all tags in a scope, sorted"
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT name FROM tags WHERE scope = ? AND owner_id = ? ORDER BY name',
+                (scope, self._owner(scope, owner_id)))
+            return [name for name, in rows]
+
+    def iter_tags(self, page_size=1000):
+        '''Yields (scope, owner_id, name, value) for every tag, in key order.
+        Tags are read a page at a time, so the database isn't held for the whole iteration,
+        and tags changed meanwhile may or may not be seen'''
+        after = (-1, 0, '')
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT scope, owner_id, name, value FROM tags '
+                    'WHERE scope > ? OR (scope = ? AND (owner_id > ? OR (owner_id = ? AND name > ?))) '
+                    'ORDER BY scope, owner_id, name LIMIT ?',
+                    (after[0], after[0], after[1], after[1], after[2], page_size)).fetchall()
+            for scope, owner_id, name, value in rows:
+                yield TagScope(scope), owner_id, name, value
+            if len(rows) < page_size:
+                return
+            after = rows[-1][:3]
+
+    def set_many(self, tags, *, overwrite=True):
+        '''Sets every (scope, owner_id, name, value) of tags in one transaction.
+        Existing tags are kept instead if overwrite is False. Returns how many were written'''
+        written = 0
+        with self.batch():
+            for scope, owner_id, name, value in tags:
+                self._validate_tagname(name)
+                owner_id = self._owner(scope, owner_id)
+                if not overwrite and self._db.execute(
+                        'SELECT 1 FROM tags WHERE scope = ? AND owner_id = ? AND name = ?',
+                        (scope, owner_id, name)).fetchone():
+                    continue
+                self._insert(scope, owner_id, name, value)
+                self._cache_put((scope, owner_id, name), value)
+                written += 1
+        return written
+
+    def complete(self, user_id, guild_id, prefix, limit=10):
+        "Returns up to limit names starting with prefix that resolve() can find, sorted"
+        names = set()
+        with self._lock:
+            for scope, owner_id in self.owners(user_id, guild_id):
+                rows = self._db.execute(
+                    'SELECT name FROM tags WHERE scope = ? AND owner_id = ? AND name >= ? AND name < ? '
+                    'ORDER BY name LIMIT ?',
+                    (scope, owner_id, prefix, prefix + '\U0010ffff', limit))
+                names.update(name for name, in rows)
+        return sorted(names)[:limit]
+
+    def suggest(self, user_id, guild_id, name, limit=3):
+        "Returns up to limit names that resolve() can find which are similar to name, most similar first"
+        grams = trigrams(name)
+        placeholders = ','.join('?' * len(grams))
+        shared = {}
+        with self._lock:
+            for scope, owner_id in self.owners(user_id, guild_id):
+                rows = self._db.execute(
+                    'SELECT name, COUNT(*) FROM tag_trigrams '
+                    'WHERE trigram IN ({}) AND scope = ? AND owner_id = ? GROUP BY name'.format(placeholders),
+                    (*grams, scope, owner_id))
+                for candidate, count in rows:
+                    shared[candidate] = max(shared.get(candidate, 0), count)
+
+        scored = []
+        for candidate, count in shared.items():
+            similarity = count / (len(grams) + len(trigrams(candidate)) - count)
+            if similarity >= self.min_similarity and candidate != name:
+                scored.append((-similarity, candidate))
+        scored.sort()
+        return [candidate for _, candidate in scored[:limit]]
+
+    def owners(self, user_id, guild_id):
+        "Returns the (scope, owner id) pairs resolve() looks at, in order"
+        owners = [(TagScope.USER, user_id)]
+        if guild_id is not None:
+            owners.append((TagScope.GUILD, guild_id))
+        owners.append((TagScope.GLOBAL, 0))
+        return owners
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Makes the writes in the with block a single transaction, committed when it exits.
+        Blocks can be nested, only the outermost one commits'''
+        with self._lock:
+            if not self._batch_depth:
+                self._db.execute('BEGIN IMMEDIATE')
+            self._batch_depth += 1
+            try:
+                yield
+            except BaseException:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._db.execute('ROLLBACK')
+                    # What was cached during the transaction may have been rolled back
+                    self._cache.clear()
+                raise
+            else:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._db.execute('COMMIT')
+                    # Our own commit doesn't change the data version, only other connections' do
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _owner(self, scope, owner_id):
+        return 0 if scope == TagScope.GLOBAL else owner_id
+
+    def _lookup(self, scope, owner_id, name):
+        "Returns the tag's value, or _MISSING"
+        key = (scope, owner_id, name)
+        with self._lock:
+            self._check_version()
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+                return value
+
+            row = self._db.execute(
+                'SELECT value FROM tags WHERE scope = ? AND owner_id = ? AND name = ?', key).fetchone()
+            value = row[0] if row else _MISSING
+            self._cache_put(key, value)
+            return value
+
+    def _insert(self, scope, owner_id, name, value):
+        self._db.execute(
+            'INSERT OR REPLACE INTO tags (scope, owner_id, name, value) VALUES (?, ?, ?, ?)',
+            (scope, owner_id, name, value))
+        self._db.executemany(
+            'INSERT OR IGNORE INTO tag_trigrams (trigram, scope, owner_id, name) VALUES (?, ?, ?, ?)',
+            ((gram, scope, owner_id, name) for gram in trigrams(name)))
+
+    def _cache_put(self, key, value):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _check_version(self):
+        "Drops the cache if another connection (like another shard's) committed since the last check"
+        version = self._db.execute('PRAGMA data_version').fetchone()[0]
+        self._checked_at = time.monotonic()
+        if version != self._data_version:
+            self._data_version = version
+            self._cache.clear()
+
+    def _migrate(self):
+        "Brings the schema up to date, a version at a time"
+        migrations = [self._schema_1, self._schema_2]
+        for version, migration in enumerate(migrations, 1):
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                # Checked in the transaction, as another process may have just migrated
+                if self._db.execute('PRAGMA user_version').fetchone()[0] < version:
+                    migration()
+                    self._db.execute('PRAGMA user_version = {:d}'.format(version))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def _schema_1(self):
+        "Tags per user. Databases made before versioning are already at this version"
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS tags (
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (user_id, name)) WITHOUT ROWID''')
+
+    def _schema_2(self):
+        "Tags in scopes, and the trigram index"
+        self._db.execute('''CREATE TABLE scoped_tags (
+            scope INTEGER NOT NULL,
+            owner_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (scope, owner_id, name)) WITHOUT ROWID''')
+        self._db.execute(
+            'INSERT INTO scoped_tags (scope, owner_id, name, value) SELECT ?, user_id, name, value FROM tags',
+            (TagScope.USER,))
+        self._db.execute('DROP TABLE tags')
+        self._db.execute('ALTER TABLE scoped_tags RENAME TO tags')
+
+        self._db.execute('''CREATE TABLE tag_trigrams (
+            trigram TEXT NOT NULL,
+            scope INTEGER NOT NULL,
+            owner_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (trigram, scope, owner_id, name)) WITHOUT ROWID''')
+        rows = self._db.execute('SELECT scope, owner_id, name FROM tags').fetchall()
+        self._db.executemany(
+            'INSERT INTO tag_trigrams (trigram, scope, owner_id, name) VALUES (?, ?, ?, ?)',
+            ((gram, scope, owner_id, name) for scope, owner_id, name in rows for gram in trigrams(name)))
+
+    def _migrate_shelve(self, legacy_path):
+        "Copies the tags of the old shelve database, once"
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            done = self._db.execute("SELECT value FROM meta WHERE key = 'shelve_migrated'").fetchone()
+            # dbm adds its own extensions to the name
+            legacy_files = [f for f in glob.glob(legacy_path + '*') if not f.endswith('.lock')]
+            if not done and legacy_files:
+                count = 0
+                with shelve.open(legacy_path, flag='r') as s:
+                    for userkey in s.keys():
+                        if not userkey.startswith('user_'):
+                            continue
+                        user_id = int(userkey[len('user_'):])
+                        for name, value in s[userkey].items():
+                            self._insert(TagScope.USER, user_id, name, value)
+                            count += 1
+                logging.info('Migrated %d tags from %s', count, legacy_path)
+            if not done:
+                self._db.execute(
+                    "INSERT INTO meta (key, value) VALUES ('shelve_migrated', ?)", (str(time.time()),))
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+
+class AsyncTagDatabase:
+    '''Wraps a TagDatabase for use from the event loop.
+
+    Database work runs on a single thread of its own, so it never blocks the loop,
+    and writes are applied in the order they're made. Writes made while others are
+    in flight are committed together, in one transaction. Tags in the cache are
+    returned right away, as long as it was checked against other connections
+    within max_staleness seconds.
+    '''
+
+    max_staleness = 1.0
+
+    def __init__(self, db : TagDatabase):
+        self.db = db
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._writes = []
+        self._flushing = False
+
+    async def set(self, user_id, name, value):
+        "This is a coroutine. Sets a tag for that user, returning once its committed"
+        await self.set_scoped(TagScope.USER, user_id, name, value)
+
+    async def set_scoped(self, scope, owner_id, name, value):
+        "This is a coroutine. Sets a tag in a scope, returning once its committed"
+        self.db._validate_tagname(name)
+        future = asyncio.get_event_loop().create_future()
+        self._writes.append((scope, owner_id, name, value, future))
+        if not self._flushing:
+            self._flushing = True
+            asyncio.ensure_future(self._flush())
+        await future
+
+    async def get(self, user_id, name):
+        '''This is a coroutine. Gets the tag identified by the name for that user.
+        Raises KeyError if it does not exist'''
+        self.db._validate_tagname(name)
+        value = self.db.peek(TagScope.USER, user_id, name, self.max_staleness)
+        if value is not None:
+            return value
+        return await self._run(self.db.get, user_id, name)
+
+    async def resolve(self, user_id, guild_id, name):
+        '''This is a coroutine. Gets the tag identified by name from the user's,
+        the guild's, then the global tags. Raises KeyError if none have it'''
+        self.db._validate_tagname(name)
+        for scope, owner_id in self.db.owners(user_id, guild_id):
+            try:
+                value = self.db.peek(scope, owner_id, name, self.max_staleness)
+            except KeyError:
+                continue
+            if value is None:
+                # Not cached, so the database has to be asked after all
+                return await self._run(self.db.resolve, user_id, guild_id, name)
+            return value
+        raise KeyError(name)
+
+    async def try_get(self, user_id, name, default=None, *, guild_id=None):
+        '''This is a coroutine. Gets the tag identified by name for that user,
+        returning default if it doesn't exist. See TagDatabase.try_get'''
+        try:
+            return await self.resolve(user_id, guild_id, name)
+        except KeyError:
+            return default
+        except InvalidTagException:
+            return default
+
+    async def keys_for(self, user_id):
+        "This is a coroutine. Returns the names of all tags belonging to that user"
+        return await self._run(self.db.keys_for, user_id)
+
+    async def names(self, scope, owner_id):
+        "This is a coroutine. Returns the names of all tags in a scope"
+        return await self._run(self.db.names, scope, owner_id)
+
+    async def complete(self, user_id, guild_id, prefix, limit=10):
+        "This is a coroutine. Returns names starting with prefix. See TagDatabase.complete"
+        return await self._run(self.db.complete, user_id, guild_id, prefix, limit)
+
+    async def suggest(self, user_id, guild_id, name, limit=3):
+        "This is a coroutine. Returns names similar to name. See TagDatabase.suggest"
+        return await self._run(self.db.suggest, user_id, guild_id, name, limit)
+
+    def close(self):
+        "Waits for pending database work to finish and closes the database"
+        self._executor.shutdown(wait=True)
+        self.db.close()
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    async def _flush(self):
+        "Writes everything queued, a transaction at a time, until nothing is left"
+        try:
+            while self._writes:
+                writes, self._writes = self._writes, []
+                try:
+                    await self._run(self._write_all, writes)
+                except Exception as ex:
+                    for *_, future in writes:
+                        if not future.done():
+                            future.set_exception(ex)
+                    continue
+
+                for *_, future in writes:
+                    if not future.done():
+                        future.set_result(None)
+        finally:
+            self._flushing = False
+
+    def _write_all(self, writes):
+        with self.db.batch():
+            for scope, owner_id, name, value, _ in writes:
+                self.db.set_scoped(scope, owner_id, name, value)
@@ -0,0 +1,124 @@
+'''Streams tags between a TagDatabase and JSON Lines files, one tag per line:
+
+    {"scope": "user", "owner_id": 1234, "name": "song", "value": "https://..."}
+
+Neither direction holds more than a batch of tags in memory, so it works the same whatever
+the size of the database. It can be run on its own, while the bot keeps running:
+
+    python -m core.tagio export tags.jsonl
+    python -m core.tagio import tags.jsonl
+    python -m core.tagio export --shelve database/tag.sdb tags.jsonl
+'''
+import argparse
+import json
+import logging
+import shelve
+import sys
+
+from .tagdatabase import TagDatabase, TagScope, InvalidTagException
+
+def export_tags(tags, file):
+    "Writes every (scope, owner_id, name, value) of tags to file as JSON Lines. Returns how many were written"
+    count = 0
+    for scope, owner_id, name, value in tags:
+        record = {'scope': scope.name.lower(), 'owner_id': owner_id, 'name': name, 'value': value}
+        file.write(json.dumps(record, ensure_ascii=False))
+        file.write('\n')
+        count += 1
+    return count
+
+def import_tags(db : TagDatabase, file, *, batch_size=1000, overwrite=True):
+    '''Reads tags from a JSON Lines file into db, committing a transaction every batch_size lines.
+    Tags that appear more than once are only written once: the last one wins, or the one
+    already in the database if overwrite is False. Invalid lines are logged and skipped.
+    Returns (tags written, lines skipped)'''
+    written = skipped = 0
+    batch = {}
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            scope = TagScope[record['scope'].upper()]
+            owner_id = 0 if scope == TagScope.GLOBAL else int(record['owner_id'])
+            name, value = record['name'], record['value']
+            if not isinstance(name, str) or not isinstance(value, str):
+                raise ValueError('name and value must be strings')
+            db._validate_tagname(name)
+        except (ValueError, KeyError, TypeError, AttributeError, InvalidTagException) as ex:
+            logging.warning('Skipping line %d of the tag import: %s', number, ex)
+            skipped += 1
+            continue
+
+        key = (scope, owner_id, name)
+        if overwrite:
+            batch[key] = value
+        else:
+            batch.setdefault(key, value)
+        if len(batch) >= batch_size:
+            written += _write(db, batch, overwrite)
+            batch.clear()
+
+    written += _write(db, batch, overwrite)
+    return written, skipped
+
+def iter_shelve(path):
+    "Yields (scope, owner_id, name, value) for every tag of an old shelve tag database, a user at a time"
+    with shelve.open(path, flag='r') as s:
+        for userkey in s.keys():
+            if not userkey.startswith('user_'):
+                continue
+            user_id = int(userkey[len('user_'):])
+            for name, value in s[userkey].items():
+                yield TagScope.USER, user_id, name, value
+
+def _write(db, batch, overwrite):
+    return db.set_many(((scope, owner_id, name, value) for (scope, owner_id, name), value in batch.items()),
+        overwrite=overwrite)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m core.tagio', description='Exports or imports tags as JSON Lines')
+    parser.add_argument('--db', default='database/tags.db', help='the tag database (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    export_parser = commands.add_parser('export', help='writes every tag to a file')
+    export_parser.add_argument('file', nargs='?', default='-', help='the file to write, - for stdout (the default)')
+    export_parser.add_argument('--shelve', metavar='PATH', help='export an old shelve database instead')
+
+    import_parser = commands.add_parser('import', help='reads tags from a file')
+    import_parser.add_argument('file', nargs='?', default='-', help='the file to read, - for stdin (the default)')
+    import_parser.add_argument('--keep-existing', action='store_true', help="don't overwrite tags that already exist")
+    import_parser.add_argument('--batch-size', type=int, default=1000, help='tags per transaction (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+
+    if args.command == 'export':
+        out = sys.stdout if args.file == '-' else open(args.file, 'w', encoding='utf-8')
+        try:
+            if args.shelve:
+                count = export_tags(iter_shelve(args.shelve), out)
+            else:
+                db = TagDatabase(args.db)
+                try:
+                    count = export_tags(db.iter_tags(), out)
+                finally:
+                    db.close()
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        logging.info('Exported %d tags', count)
+    else:
+        source = sys.stdin if args.file == '-' else open(args.file, encoding='utf-8')
+        db = TagDatabase(args.db)
+        try:
+            written, skipped = import_tags(db, source, batch_size=args.batch_size, overwrite=not args.keep_existing)
+        finally:
+            db.close()
+            if source is not sys.stdin:
+                source.close()
+        logging.info('Imported %d tags, skipped %d lines', written, skipped)
+
+if __name__ == '__main__':
+    main()
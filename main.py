@@ -2,6 +2,7 @@ import sys
 import traceback
 import os
 import asyncio
+import multiprocessing
 
 import config
 import discord
@@ -14,8 +15,8 @@ from discord.ext import commands
 import logging
 from logging.handlers import TimedRotatingFileHandler
 
-def setup_logging():
-    "Set up logging (and ensure directory)"
+def setup_logging(filename='log.txt'):
+    "Set up logging (and ensure directory). Every cluster process logs to its own file"
 
     # Set up log directory first
     os.makedirs('logs', exist_ok=True)
@@ -23,7 +24,7 @@ def setup_logging():
     normal_formatter = logging.Formatter('%(name)s %(message)s')
     full_formatter = logging.Formatter('%(asctime)s %(levelname)s:%(name)s %(message)s')
 
-    file_handler = logging.handlers.TimedRotatingFileHandler("logs/log.txt", when='midnight')
+    file_handler = logging.handlers.TimedRotatingFileHandler(os.path.join('logs', filename), when='midnight')
     file_handler.setLevel(config.loglevel)
     file_handler.setFormatter(full_formatter)
 
@@ -61,18 +62,21 @@ async def command_error(ctx, exc):
     print('Ignoring exception in command {}'.format(ctx.command), file=sys.stderr)
     traceback.print_exception(type(exc), exc, exc.__traceback__, file=sys.stderr)
 
-if __name__ == '__main__':
-    setup_logging()
-
-    # Ensure database folder exists
-    os.makedirs('database', exist_ok=True)
-
+def create_bot(cluster=None, shard_count=None):
+    """Creates the bot with every plugin.
+    If a ClusterClient is given, the bot only runs the cluster's shards"""
     prefixes = commands.when_mentioned_or('!')
     description = "Supe's glorious and handsome bot"
 
-    tagdb = core.TagDatabase()
+    tagdb = core.AsyncTagDatabase(core.TagDatabase())
 
-    bot = commands.Bot(command_prefix=prefixes, description=description)
+    if cluster:
+        bot = commands.AutoShardedBot(
+            command_prefix=prefixes, description=description,
+            shard_ids=cluster.shard_ids, shard_count=shard_count)
+    else:
+        bot = commands.Bot(command_prefix=prefixes, description=description)
+    bot.cluster = cluster
     bot.on_command_error = command_error
     bot.add_cog(plugins.AdministrativePlugin(bot))
     bot.add_cog(plugins.MusicPlayerPlugin(bot, tagdb))
@@ -80,5 +84,38 @@ if __name__ == '__main__':
     bot.add_cog(plugins.RandomGamePlugin(bot, config.games))
 
     logging.info("Bot plugins initialized")
+    return bot
+
+def run_cluster(cluster_id, shard_ids, shard_count, connection):
+    "Runs one cluster of shards. This is the entry point of each process started by the ClusterSupervisor"
+    setup_logging('cluster-{}.txt'.format(cluster_id))
+
+    cluster = core.ClusterClient(cluster_id, shard_ids, connection)
+    bot = create_bot(cluster, shard_count)
+    # Without the supervisor, nothing would stop or restart this cluster
+    cluster.start(bot.loop, on_lost=bot.close)
+
     bot.run(config.credentials)
-    logging.info("Bot shut down")
+    logging.info("Cluster %d shut down", cluster_id)
+
+if __name__ == '__main__':
+    # Worker processes aren't forked from this one, as it runs threads.
+    # Cluster processes are spawned, and inherit this for their own workers
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method('forkserver')
+
+    # Ensure database folder exists
+    os.makedirs('database', exist_ok=True)
+
+    if config.cluster_processes > 1:
+        setup_logging('supervisor.txt')
+        supervisor = core.ClusterSupervisor(
+            run_cluster,
+            processes=config.cluster_processes,
+            shard_count=config.shard_count)
+        supervisor.run()
+    else:
+        setup_logging()
+        bot = create_bot()
+        bot.run(config.credentials)
+        logging.info("Bot shut down")
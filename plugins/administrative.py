@@ -7,6 +7,22 @@ from discord.ext import commands
 class AdministrativePlugin(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        if bot.cluster:
+            bot.cluster.register('stats', self.local_stats)
+
+    def local_stats(self, payload=None):
+        """Returns this process's stats as a dict.
+        Cogs with a stats() method returning a dict of numbers add to it"""
+        stats = {
+            'cluster': self.bot.cluster.cluster_id if self.bot.cluster else 0,
+            'guilds': len(self.bot.guilds),
+            'voice': len(self.bot.voice_clients),
+            'latency': round(self.bot.latency * 1000),
+        }
+        for cog in self.bot.cogs.values():
+            if cog is not self and hasattr(cog, 'stats'):
+                stats.update(cog.stats())
+        return stats
 
     async def check_not_direct(self, ctx):
         if self.bot.user.mention not in ctx.prefix:
@@ -49,3 +65,35 @@ class AdministrativePlugin(commands.Cog):
         image_data = await res.read()
         await self.bot.edit_profile(avatar=image_data)
         print('avatar set')
+
+    @commands.is_owner()
+    @commands.command(name='clusterstats')
+    async def clusterstats_cmd(self, ctx):
+        "Shows stats for every cluster of the bot, and their totals"
+        if self.bot.cluster:
+            results = [r for r in await self.bot.cluster.broadcast('stats') if r]
+        else:
+            results = [self.local_stats()]
+        results.sort(key=lambda r: r['cluster'])
+
+        totals = {}
+        lines = []
+        for stats in results:
+            lines.append(' | '.join('{}: {}'.format(k, v) for k, v in stats.items()))
+            for key, value in stats.items():
+                if key not in ('cluster', 'latency'):
+                    totals[key] = totals.get(key, 0) + value
+        lines.append('total | ' + ' | '.join('{}: {}'.format(k, v) for k, v in totals.items()))
+        await ctx.send('```{}```'.format('\n'.join(lines)))
+
+    @commands.is_owner()
+    @commands.command(name='restartcluster')
+    async def restartcluster_cmd(self, ctx, cluster_id: int):
+        "Restarts a cluster of the bot. It may be this one"
+        if not self.bot.cluster:
+            await ctx.send('The bot is not running as a cluster')
+            return
+
+        await ctx.send('Restarting cluster {}'.format(cluster_id))
+        if not await self.bot.cluster.control('restart', cluster_id):
+            await ctx.send('There is no running cluster {}'.format(cluster_id))
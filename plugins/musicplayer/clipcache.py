@@ -0,0 +1,235 @@
+import asyncio
+import json
+import os
+import subprocess
+import time
+import uuid
+import logging
+
+from core.filelock import locked
+from .songcache import normalize_lookup
+
+class ClipCache:
+    '''Stores frequently played short clips on disk, already encoded as Ogg Opus.
+
+    Songs are counted every time they're played. Once a short enough song has
+    been played promote_after times its encoded in the background. Cached clips
+    are evicted least recently played first when the total goes over max_bytes.
+
+    If a MemoryClipCache is given, cached clips are also kept in memory.
+    If a LoudnessCache is given, clips are encoded already normalized, so that
+    they can be sent as they are at 100% volume. Songs are then only encoded
+    once their loudness is known.
+    The directory can be shared by several processes (shards), as saving the
+    index merges in what the others saved.
+    '''
+
+    # How many songs to keep play counts for, and how often to save them
+    max_tracked = 10000
+    save_interval = 60
+
+    def __init__(self, directory, *, memory=None, loudness=None, max_bytes=500*1024*1024, promote_after=3,
+                 max_duration=30, bitrate=128):
+        self.directory = directory
+        self.memory = memory
+        self.loudness = loudness
+        self.max_bytes = max_bytes
+        self.promote_after = promote_after
+        self.max_duration = max_duration
+        self.bitrate = bitrate
+
+        # key -> {'plays', 'last', 'file', 'size', 'gain', 'loudness'}. Entries without a file only count plays.
+        # gain is the normalization gain the clip was encoded with, and loudness what was measured of its source
+        self._entries = {}
+        self._encoding = set()
+        self._index_path = os.path.join(directory, 'index.json')
+        self._saved_at = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @property
+    def total_bytes(self):
+        return sum(e['size'] for e in self._entries.values() if e['file'])
+
+    def path_for(self, song):
+        "Returns the path of the song's cached clip, or None if its not cached"
+        entry = self._entries.get(normalize_lookup(song.url))
+        if not entry or not entry['file']:
+            return None
+
+        path = os.path.join(self.directory, entry['file'])
+        if not os.path.exists(path):
+            entry['file'] = None
+            return None
+
+        entry['last'] = time.time()
+        return path
+
+    def gain_of(self, song):
+        '''Returns the gain the song's cached clip was encoded with, or None if its not cached.
+        Sets the song's loudness to its source's if its not known, as the clip's own is already changed'''
+        if not self.path_for(song):
+            return None
+        entry = self._entries[normalize_lookup(song.url)]
+        if song.loudness is None:
+            song.loudness = entry.get('loudness')
+        return entry.get('gain', 1.0)
+
+    def memory_clip(self, song, *, opus):
+        '''Returns the song's clip as a MemoryClip, or None if its not in memory.
+        If the clip is cached on disk, its loaded into memory for the next play'''
+        if not self.memory:
+            return None
+
+        key = normalize_lookup(song.url)
+        clip = self.memory.get(key, opus=opus)
+        if clip:
+            entry = self._entries.get(key)
+            if entry:
+                entry['last'] = time.time()
+            return clip
+
+        path = self.path_for(song)
+        if path:
+            self.memory.load(key, path, opus=opus)
+        return None
+
+    def record_play(self, song):
+        '''Counts a play of the song, and starts encoding it if its been played often enough.
+        The song's source has to be resolved, as its what gets encoded'''
+        key = normalize_lookup(song.url)
+        entry = self._entries.get(key)
+        if not entry:
+            entry = self._entries[key] = {'plays': 0, 'last': time.time(), 'file': None, 'size': 0}
+            if len(self._entries) > self.max_tracked:
+                self._forget_oldest()
+        entry['plays'] += 1
+        entry['last'] = time.time()
+        if entry['last'] - self._saved_at > self.save_interval:
+            self._save()
+
+        promote = (
+            not entry['file']
+            and key not in self._encoding
+            and entry['plays'] >= self.promote_after
+            and song.source
+            and song.duration and song.duration <= self.max_duration)
+        if promote and self.loudness:
+            gain = self.loudness.gain_for(song)
+            promote = song.loudness is not None
+        else:
+            gain = 1.0
+        if promote:
+            self._encoding.add(key)
+            asyncio.ensure_future(self._promote(key, song.source, gain, song.loudness))
+
+    async def _promote(self, key, source, gain, loudness):
+        filename = uuid.uuid4().hex + '.ogg'
+        path = os.path.join(self.directory, filename)
+        try:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._encode, source, path, gain)
+        except Exception:
+            logging.exception('Could not encode clip for %s', key)
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        finally:
+            self._encoding.discard(key)
+
+        entry = self._entries.get(key)
+        if not entry:
+            os.remove(path)
+            return
+
+        entry['file'] = filename
+        entry['size'] = os.path.getsize(path)
+        entry['gain'] = gain
+        entry['loudness'] = loudness
+        self._evict()
+        self._save()
+        logging.info('Cached clip for %s', key)
+
+    def _encode(self, source, path, gain=1.0):
+        "Blocks while ffmpeg encodes source into an Ogg Opus file with 20ms frames, scaled by gain"
+        subprocess.run([
+            'ffmpeg', '-nostdin', '-loglevel', 'error', '-y',
+            '-i', source,
+            '-t', str(self.max_duration), '-vn',
+            '-af', 'volume={:.6f}'.format(gain),
+            '-ar', '48000', '-ac', '2',
+            '-c:a', 'libopus', '-b:a', '{}k'.format(self.bitrate), '-frame_duration', '20',
+            '-f', 'ogg', path
+        ], check=True, stdin=subprocess.DEVNULL, timeout=120)
+
+    def _evict(self):
+        stored = sorted((e['last'], key) for key, e in self._entries.items() if e['file'])
+        total = self.total_bytes
+        for _, key in stored:
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            total -= entry['size']
+            try:
+                os.remove(os.path.join(self.directory, entry['file']))
+            except OSError:
+                pass
+            entry['file'] = None
+            entry['size'] = 0
+            if self.memory:
+                self.memory.discard(key)
+
+    def _forget_oldest(self):
+        "Drops the play counts of the least recently played songs that aren't cached"
+        counted = sorted((e['last'], key) for key, e in self._entries.items() if not e['file'])
+        for _, key in counted[:len(counted) // 10]:
+            del self._entries[key]
+
+    def _load(self):
+        self._entries = self._read()
+
+    def _read(self):
+        "Returns the index saved on disk"
+        try:
+            with open(self._index_path, encoding='utf8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.exception('Could not read clip cache index at %s', self._index_path)
+            return {}
+
+    def _merge(self, saved):
+        "Merges in entries another process saved"
+        for key, other in saved.items():
+            entry = self._entries.get(key)
+            if not entry:
+                self._entries[key] = other
+                continue
+
+            entry['plays'] = max(entry['plays'], other['plays'])
+            entry['last'] = max(entry['last'], other['last'])
+            if other['file'] and other['file'] != entry['file']:
+                # Both encoded the clip, so the one saved first is kept
+                if entry['file']:
+                    try:
+                        os.remove(os.path.join(self.directory, entry['file']))
+                    except OSError:
+                        pass
+                entry['file'] = other['file']
+                entry['size'] = other['size']
+                entry['gain'] = other.get('gain', 1.0)
+                entry['loudness'] = other.get('loudness')
+
+    def _save(self):
+        self._saved_at = time.time()
+        with locked(self._index_path):
+            self._merge(self._read())
+            temp_path = self._index_path + '.tmp'
+            try:
+                with open(temp_path, 'w', encoding='utf8') as f:
+                    json.dump(self._entries, f)
+                os.replace(temp_path, self._index_path)
+            except OSError:
+                logging.exception('Could not write clip cache index at %s', self._index_path)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+import weakref
+
+import discord
+
+# Opus encoder ctls that discord.opus.Encoder doesn't wrap
+CTL_SET_COMPLEXITY = 4010
+CTL_SET_FORCE_CHANNELS = 4022
+OPUS_AUTO = -1000
+
+MAX_COMPLEXITY = 10
+
+class TimedEncoder:
+    '''Wraps a voice client's discord.opus.Encoder, timing every encode.
+
+    Settings changes are applied by the thread that encodes, right before its
+    next frame, as the Opus encoder can't be changed while its encoding.
+    '''
+
+    def __init__(self, encoder : discord.opus.Encoder):
+        self.encoder = encoder
+        self.encode_time = 0.0
+        self.frames = 0
+        # encode_time when the EncoderTuner last measured it
+        self.measured_time = 0.0
+
+        self.bitrate = 128
+        self.complexity = MAX_COMPLEXITY
+        self.channels = 2
+        self._pending = {}
+
+    def __getattr__(self, name):
+        # Everything else, like the frame size constants, is the encoder's
+        return getattr(self.encoder, name)
+
+    def encode(self, pcm, frame_size):
+        if self._pending:
+            self._apply()
+        start = time.perf_counter()
+        data = self.encoder.encode(pcm, frame_size)
+        self.encode_time += time.perf_counter() - start
+        self.frames += 1
+        return data
+
+    def configure(self, *, bitrate=None, complexity=None, channels=None):
+        "Changes the encoder's settings. bitrate is in kbps, channels is 1 or 2"
+        if bitrate is not None:
+            self.bitrate = max(16, min(512, int(bitrate)))
+            self._pending['bitrate'] = self.bitrate
+        if complexity is not None:
+            self.complexity = complexity
+            self._pending[CTL_SET_COMPLEXITY] = complexity
+        if channels is not None:
+            self.channels = channels
+            self._pending[CTL_SET_FORCE_CHANNELS] = 1 if channels == 1 else OPUS_AUTO
+
+    def _apply(self):
+        while self._pending:
+            request, value = self._pending.popitem()
+            if request == 'bitrate':
+                self.encoder.set_bitrate(value)
+            else:
+                discord.opus._lib.opus_encoder_ctl(self.encoder._state, request, value)
+
+class EncoderTuner:
+    '''Sets up the Opus encoder of every voice client for its channel, and keeps their load within a budget.
+
+    Bitrate follows the channel's. Low bitrate channels are encoded in mono and
+    at a lower complexity, as they can't carry the difference. Every interval
+    seconds, the encode time spent across every encoder per 20ms of real time is
+    compared to budget_ms. Over it, complexity is lowered a step everywhere, and
+    under half of it, raised a step again.
+    '''
+
+    def __init__(self, *, budget_ms=10.0, interval=5, min_complexity=2):
+        self.budget_ms = budget_ms
+        self.interval = interval
+        self.min_complexity = min_complexity
+
+        # The highest complexity any encoder may use right now, and the last measured load
+        self.level = MAX_COMPLEXITY
+        self.load_ms = 0.0
+
+        self._encoders = weakref.WeakKeyDictionary() # TimedEncoder -> its channel's complexity limit
+        self._measured_at = time.perf_counter()
+
+    def attach(self, voice_client, channel_bitrate):
+        '''Wraps the voice client's encoder if it wasn't yet, and sets it up for a channel bitrate (in bps).
+        Returns the TimedEncoder'''
+        encoder = voice_client.encoder
+        if not isinstance(encoder, TimedEncoder):
+            encoder = voice_client.encoder = TimedEncoder(encoder)
+
+        kbps = channel_bitrate // 1000
+        if kbps <= 32:
+            limit, channels = 6, 1
+        elif kbps <= 64:
+            limit, channels = 8, 2
+        else:
+            limit, channels = MAX_COMPLEXITY, 2
+        self._encoders[encoder] = limit
+        encoder.configure(bitrate=kbps, complexity=min(limit, self.level), channels=channels)
+        return encoder
+
+    async def run(self):
+        "This is a coroutine. Measures the load and adjusts complexity every interval, forever"
+        while True:
+            await asyncio.sleep(self.interval)
+            self.update()
+
+    def update(self):
+        "Measures the encode load since the last update, and adjusts complexity to it"
+        now = time.perf_counter()
+        # Each encoder's time since it was last measured, so that encoders that went away
+        # since don't take the time they spent before with them
+        encode_time = 0.0
+        for encoder in list(self._encoders):
+            total = encoder.encode_time
+            encode_time += total - encoder.measured_time
+            encoder.measured_time = total
+        elapsed = now - self._measured_at
+        self.load_ms = encode_time / elapsed * 20 if elapsed else 0.0
+        self._measured_at = now
+
+        level = self.level
+        if self.load_ms > self.budget_ms:
+            level = max(self.min_complexity, level - 1)
+        elif self.load_ms < self.budget_ms / 2:
+            level = min(MAX_COMPLEXITY, level + 1)
+        if level == self.level:
+            return
+
+        logging.info('Encoding took %.2fms per frame, changing complexity from %d to %d',
+            self.load_ms, self.level, level)
+        self.level = level
+        for encoder, limit in list(self._encoders.items()):
+            complexity = min(limit, level)
+            if encoder.complexity != complexity:
+                encoder.configure(complexity=complexity)
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import youtube_dl
+from youtube_dl.utils import DownloadError
+
+# The YoutubeDL instance owned by a worker process. Built on the first job
+# so that every extractor is only initialized once per worker.
+_ydl = None
+
+def _get_ydl():
+    global _ydl
+    if _ydl is None:
+        _ydl = youtube_dl.YoutubeDL({
+            'format': 'bestaudio/best',
+            'noplaylist': False,
+            'ignoreerrors': True,
+            'nocheckcertificate': True,
+            'logtostderr': False,
+            'quiet': True
+        })
+    return _ydl
+
+def _flat_entry_url(entry):
+    "Returns the page url of an entry from a flat playlist extraction"
+    url = entry.get('webpage_url') or entry['url']
+    if entry.get('ie_key') == 'Youtube' and '://' not in url:
+        url = 'https://www.youtube.com/watch?v=' + url
+    return url
+
+def _extract_songs(url: str, noplaylist: bool, flat: bool):
+    '''Runs in a worker process. Returns (title, url, source, duration) tuples.
+
+    If flat is set, playlist entries are not resolved and their source is None.
+    Only the tuples are sent back, the info dicts are too big to be worth pickling.
+    '''
+    ydl = _get_ydl()
+    ydl.params['noplaylist'] = noplaylist
+    ydl.params['extract_flat'] = 'in_playlist' if flat else False
+
+    try:
+        info = ydl.extract_info(url, download=False)
+    except DownloadError as ex:
+        # The original holds a traceback in exc_info, which can't be pickled
+        raise DownloadError(str(ex)) from None
+
+    if not info:
+        raise DownloadError('Data could not be retrieved')
+
+    if '_type' in info and info['_type'] == 'playlist':
+        entries = info['entries']
+    else:
+        entries = [info]
+
+    # ignoreerrors leaves None in place of entries that failed
+    results = []
+    for e in entries:
+        if not e:
+            continue
+        if e.get('_type') == 'url':
+            page_url = _flat_entry_url(e)
+            results.append((e.get('title') or page_url, page_url, None, e.get('duration')))
+        else:
+            results.append((e['title'], e.get('webpage_url', url), e['url'], e.get('duration')))
+    if not results:
+        raise DownloadError('Data could not be retrieved')
+    return results
+
+class ExtractorPool:
+    '''A pool of long lived worker processes that run youtube_dl extraction.
+
+    Keeps youtube_dl's parsing off the bot process, where it would compete
+    for the GIL with the threads sending voice data. A job that runs longer
+    than timeout seconds is assumed hung, and the workers are replaced.
+    That breaks the other jobs running in them, so those are run again
+    in the new workers, up to retries times.
+
+    The workers should not be forked from the bot process, which runs threads.
+    Set the forkserver start method at startup, as ProcessPoolExecutor
+    can't be given one before Python 3.7.
+    '''
+
+    def __init__(self, size=2, timeout=30, retries=2):
+        self.size = size
+        self.timeout = timeout
+        self.retries = retries
+        self._executor = ProcessPoolExecutor(max_workers=size)
+
+    async def extract(self, url : str, *, noplaylist=False, flat=False):
+        '''This is a coroutine. Extracts the songs at url in a worker process.
+        Raises DownloadError on failure, including timeouts'''
+        loop = asyncio.get_event_loop()
+        attempt = 0
+        while True:
+            executor = self._executor
+            try:
+                job = loop.run_in_executor(executor, _extract_songs, url, noplaylist, flat)
+                return await asyncio.wait_for(job, self.timeout)
+            except asyncio.TimeoutError:
+                logging.warning('Extraction of %s timed out, restarting extractor workers', url)
+                self._restart(executor)
+                raise DownloadError('Timed out while retrieving data') from None
+            except BrokenProcessPool:
+                # If the workers were replaced because another job hung, this job did nothing wrong
+                if executor is not self._executor and attempt < self.retries:
+                    attempt += 1
+                    logging.info('Extractor workers were restarted, extracting %s again', url)
+                    continue
+                self._restart(executor)
+                raise DownloadError('The extractor stopped unexpectedly') from None
+
+    def shutdown(self):
+        self._kill(self._executor)
+
+    def _restart(self, executor):
+        # Another job may have restarted the pool already
+        if executor is not self._executor:
+            return
+        self._executor = ProcessPoolExecutor(max_workers=self.size)
+        self._kill(executor)
+
+    def _kill(self, executor):
+        # ProcessPoolExecutor has no way to abandon a running job,
+        # so the hung workers have to be terminated directly
+        processes = list((getattr(executor, '_processes', None) or {}).values())
+        executor.shutdown(wait=False)
+        for process in processes:
+            process.terminate()
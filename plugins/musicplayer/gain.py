@@ -0,0 +1,112 @@
+import functools
+
+import numpy as np
+import discord
+
+CHANNELS = discord.opus.Encoder.CHANNELS
+SAMPLES_PER_FRAME = discord.opus.Encoder.SAMPLES_PER_FRAME
+
+_INT16_MAX = np.float32(32767)
+_INT16_MIN = np.float32(-32768)
+
+@functools.lru_cache(maxsize=8)
+def _ramp_base(length):
+    "Returns [0, 1/length, 2/length...] for building per sample gain ramps"
+    return np.arange(length, dtype=np.float32) / np.float32(length)
+
+class GainTransformer(discord.AudioSource):
+    '''Applies volume to a PCM source with NumPy, ramping any change across frames.
+
+    Volume changes are spread over ramp_frames frames instead of stepping. The
+    source fades in over fade_in_frames, and fade_out() ends it after a fade
+    so that skipping doesn't click. Gain above 1.0 is clipped to the 16 bit range.
+    At a steady volume of 1.0 frames are passed through untouched.
+    '''
+
+    def __init__(self, original : discord.AudioSource, volume=1.0, *, ramp_frames=5, fade_in_frames=3):
+        if original.is_opus():
+            raise discord.ClientException('AudioSource must not be Opus encoded.')
+
+        self.original = original
+        self.ramp_frames = ramp_frames
+        self._target = max(volume, 0.0)
+        self._gain = 0.0 if fade_in_frames else self._target
+        self._step = self._target / fade_in_frames if fade_in_frames else 0.0
+        self._fading_out = False
+
+        frame_samples = SAMPLES_PER_FRAME * CHANNELS
+        self._scaled = np.empty(frame_samples, dtype=np.float32)
+        self._ramp = np.empty(SAMPLES_PER_FRAME, dtype=np.float32)
+        self._result = np.empty(frame_samples, dtype=np.int16)
+
+    @property
+    def volume(self):
+        "Returns the volume being ramped to"
+        return self._target
+
+    @volume.setter
+    def volume(self, value):
+        self._ramp_to(max(value, 0.0), self.ramp_frames)
+
+    def fade_out(self, frames=5):
+        "Fades to silence over the given number of frames, after which the source ends"
+        self._fading_out = True
+        self._ramp_to(0.0, frames)
+
+    def read(self):
+        if self._fading_out and self._gain == 0.0:
+            return b''
+
+        data = self.original.read()
+        if not data:
+            return data
+
+        start = self._gain
+        end = self._next_gain()
+        if start == end == 1.0:
+            return data
+
+        # Work happens in buffers kept between frames, as allocating them costs more than the math
+        samples = np.frombuffer(data, dtype=np.int16)
+        scaled = self._scaled[:len(samples)]
+        if start == end:
+            np.multiply(samples, np.float32(start), out=scaled)
+        else:
+            # A per sample ramp, so the change is smooth within the frame as well
+            base = _ramp_base(len(samples) // CHANNELS)
+            ramp = self._ramp[:len(base)]
+            np.multiply(base, np.float32(end - start), out=ramp)
+            ramp += np.float32(start)
+            np.multiply(samples.reshape(-1, CHANNELS), ramp[:, None], out=scaled.reshape(-1, CHANNELS))
+
+        if start > 1.0 or end > 1.0:
+            # Two passes are cheaper than np.clip on arrays this small
+            np.minimum(scaled, _INT16_MAX, out=scaled)
+            np.maximum(scaled, _INT16_MIN, out=scaled)
+        result = self._result[:len(samples)]
+        np.copyto(result, scaled, casting='unsafe')
+        return result.tobytes()
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    def _ramp_to(self, target, frames):
+        if not self._fading_out:
+            self._target = target
+        else:
+            target = 0.0
+        self._step = abs(target - self._gain) / frames if frames else 0.0
+        if not frames:
+            self._gain = target
+
+    def _next_gain(self):
+        "Moves the gain one frame closer to the target and returns it"
+        target = 0.0 if self._fading_out else self._target
+        if self._gain < target:
+            self._gain = min(target, self._gain + self._step)
+        elif self._gain > target:
+            self._gain = max(target, self._gain - self._step)
+        return self._gain
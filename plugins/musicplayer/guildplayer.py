@@ -1,18 +1,31 @@
 import asyncio
 import discord
+import time
 import traceback
 from .songrequestlist import SongRequestList
-from .song import Song
+from .sources import TrackedSource, OggOpusSource, MemoryAudioSource
+from .sharedstream import SharedStreams
+from .gain import GainTransformer
+from utils import AsyncDeque
 
 import logging
 from enum import Enum, auto
 
+# Submitted requests that can wait to be taken into the request list, how many are taken
+# at a time, and how long the intake waits for more before stopping
+REQUEST_BACKLOG = 1000
+REQUEST_BATCH = 250
+INTAKE_IDLE = 60
+
 class SongRequest:
     """Represents a song request from a user from a channel
     
     This is used internally by the GuildPlayer to track the songs being played.
+    The user and channel are references shared by every request made with them.
     """
 
+    __slots__ = ('song', 'request_user', 'request_channel', 'loop')
+
     def __init__(self, song, request_user, request_channel, *, loop=False):
         self.song = song
         self.request_user = request_user
@@ -31,6 +44,17 @@ class SongRequest:
     def source(self):
         return self.song.source
 
+# How many seconds before the end of a track the next one is prefetched
+PREFETCH_LEAD = 10
+
+# How many 20ms frames a skipped track takes to fade out
+SKIP_FADE_FRAMES = 5
+
+# A stream that ends more than this many seconds before the song's duration failed, and is resumed
+RESUME_TOLERANCE = 5
+# How many times a song is resumed before giving up on it
+MAX_RESUMES = 3
+
 class GuildPlayerMode(Enum):
     SINGLE = "Single"
     LINEAR = "Linear"
@@ -45,22 +69,61 @@ class GuildPlayer:
     Allows iteration over loaded requests
     '''
 
-    def __init__(self, guild, *, volume = 100, inactivity_timeout=600):
-        """Creates a new guild player
+    def __init__(self, guild, loader, *, streams=None, clip_cache=None, loudness=None, encoder_tuner=None,
+                 on_channel_change=None, offload_encoding=False, volume = 100, inactivity_timeout=600):
+        """Creates a new guild player. The loader is used to resolve songs right before playing them.
+        Audio is decoded through the SharedStreams, which should be shared with the other guild players.
+        If a ClipCache is given, cached clips are played from it and plays are counted there.
+        If a LoudnessCache is given, songs are normalized with it on top of the volume.
+        If an EncoderTuner is given, the voice client's encoder is set up with it for each channel.
+        With offload_encoding, streamed songs are decoded, scaled and encoded to Opus
+        by ffmpeg instead of in this process. Their volume can then only change between songs.
+        on_channel_change is called with (player, old_channel, new_channel) when connecting,
+        moving or disconnecting, where a channel is None if there wasn't one.
         """
 
         self.guild = guild # todo: use to validate connections?
+        self.loader = loader
+        self.streams = streams or SharedStreams()
+        self.clip_cache = clip_cache
+        self.loudness = loudness
+        self.encoder_tuner = encoder_tuner
+        self.on_channel_change = on_channel_change
+        self.offload_encoding = offload_encoding
         self.requests = SongRequestList()
+        self.incoming = AsyncDeque(REQUEST_BACKLOG)
+        self._intake = None
         self.inactivity_timeout_length = inactivity_timeout
 
         self.voice_client = None
+        self.encoder = None
+        # The channel bitrate (in bps) the encoder was last tuned for
+        self._tuned_bitrate = None
 
         self.connect_lock = asyncio.Lock()
+        # Held while connecting or moving, so that commands arriving together don't both connect.
+        # Its separate from connect_lock, which is held for as long as a song plays
+        self.channel_lock = asyncio.Lock()
         self.stop_signal = asyncio.Event()
         self.skip_signal = asyncio.Event()
         self.inactivity_timeout = None
 
         self.is_playing = False
+        self.last_active = time.monotonic()
+
+        # The next request's source, started before the current one ends (LINEAR mode only)
+        self._prefetch_task = None
+        self._prefetched = None
+        self._track_started = 0
+
+        # The GainTransformer of the currently playing source if any, and the song's normalization gain
+        self._volume_source = None
+        self._song_gain = 1.0
+
+        # Where the playing source started in the song, how many frames it played, and any requested seek
+        self._offset = 0.0
+        self._tracked = None
+        self._seek_to = None
 
         self.volume = volume
 
@@ -77,8 +140,9 @@ class GuildPlayer:
         '''Sets the guild's default volume level, and any currently playing music'''
         value = max(0, min(150, int(value)))
         self._volume = value
-        if self.voice_client:
-            self.voice_client.source.volume = value / 100
+        # Opus sources (cached clips and offloaded streams) have no volume, they get the new one on their next play
+        if self._volume_source:
+            self._volume_source.volume = value / 100 * self._song_gain
 
     @property
     def mode(self):
@@ -96,6 +160,19 @@ class GuildPlayer:
     def is_connected(self):
         return self.voice_client and self.voice_client.is_connected()
 
+    @property
+    def is_idle(self):
+        "Returns true if the player is disconnected, not playing, and has nothing queued"
+        return (not self.is_connected and not self.channel_lock.locked() and not self.is_playing
+            and not len(self.requests) and not len(self.incoming))
+
+    @property
+    def position(self):
+        "Returns how many seconds into the current song playback is, or None if not playing"
+        if not self.is_playing or not self._tracked:
+            return None
+        return self._offset + self._tracked.frames * 0.02
+
     @property
     def channel(self):
         "Returns the currently connected voice channel if connected, otherwise returns None"
@@ -109,47 +186,109 @@ class GuildPlayer:
         Does nothing if already connected to the channel.
 
         If the player was disconnected and connects, the mode will switch to SINGLE.
+        If nothing plays after connecting, the inactivity timeout disconnects it again.
         '''
-        # If we are already connected to the voice channel, do nothing
-        if self.is_connected and self.voice_client.channel is voice_channel:
+        # If we are already connected to the voice channel, do nothing.
+        if self._is_connected_to(voice_channel):
             return
 
-        # If we're moving or connecting, we have to stop
-        self.stop()
-
-        if self.is_connected:
-            # If we are already connected to a channel here, move to the other channel
-            await self.voice_client.move_to(voice_channel)
-        else:
-            # Connect; and switch to the default mode (SINGLE)
-            with await self.connect_lock:
-                self.mode = GuildPlayerMode.SINGLE
-                self.voice_client = await voice_channel.connect()         
+        # Commands connect as soon as they arrive, so another connect may be under way.
+        # Once that one is done, the state is looked at again
+        with await self.channel_lock:
+            if self._is_connected_to(voice_channel):
+                return
+
+            # If we're moving or connecting, we have to stop
+            self.stop()
+
+            old_channel = self.channel if self.is_connected else None
+            if self.is_connected:
+                # If we are already connected to a channel here, move to the other channel
+                await self.voice_client.move_to(voice_channel)
+            else:
+                # Connect; and switch to the default mode (SINGLE)
+                with await self.connect_lock:
+                    self.mode = GuildPlayerMode.SINGLE
+                    self.voice_client = await voice_channel.connect()
+
+            self.tune_encoder()
+        if self.on_channel_change:
+            self.on_channel_change(self, old_channel, voice_channel)
+
+        if not self.is_playing:
+            self._start_inactivity_timeout()
+
+    def _is_connected_to(self, voice_channel):
+        # Channels are compared by id, as the same channel can be a different object
+        return self.is_connected and self.voice_client.channel.id == voice_channel.id
+
+    def tune_encoder(self):
+        "Sets up the voice client's encoder for the channel, like when its bitrate changes"
+        if self.encoder_tuner and self.is_connected:
+            self._tuned_bitrate = self.channel.bitrate
+            self.encoder = self.encoder_tuner.attach(self.voice_client, self._tuned_bitrate)
+
+    def _check_encoder(self):
+        "Tunes the encoder again if the channel's bitrate changed without an event saying so"
+        if self.encoder and self.is_connected and self.channel.bitrate != self._tuned_bitrate:
+            self.tune_encoder()
 
     async def disconnect(self):
         self.stop()
         with await self.connect_lock:
+            old_channel = self.channel
             if self.voice_client:
                 await self.voice_client.disconnect()
             self.voice_client = None
+            self.encoder = None
+
+        if self.on_channel_change and old_channel:
+            self.on_channel_change(self, old_channel, None)
+
+    async def submit(self, songs, request_user, request_channel, *, loop=False):
+        """This is a coroutine. Requests songs. The mode decides what happens.
 
-    def request_song(self, song : Song, request_user, request_channel, loop=False):
-        """Requests a song. The mode decides what happens.
-        
-        SINGLE: Stops the song, clears the list
-        LINEAR: Adds the song to the list
+        SINGLE: Stops the song, clears the list, and plays the last of the songs
+        LINEAR: Adds the songs to the list
 
-        No matter the mode, the guild player will begin playing if its currently
-        not playing. The procedure is added to the asyncio event loop.
+        The songs go through the player's intake, which adds them a batch at a time,
+        and starts playing once they're added if connected. Waits while the intake is full,
+        so that large playlists are taken in at the pace the request list can take them.
         """
-        request = SongRequest(song, request_user, request_channel, loop=loop)
-        
+        requests = [SongRequest(song, request_user, request_channel, loop=loop) for song in songs]
+        self.last_active = time.monotonic()
+        if not self._intake or self._intake.done():
+            self._intake = asyncio.ensure_future(self._take_requests())
+        await self.incoming.put_many(requests)
+
+    async def _take_requests(self):
+        "This is a coroutine. Moves submitted requests into the request list and plays them, until none come for a while"
+        while True:
+            try:
+                requests = await self.incoming.get_many(REQUEST_BATCH, timeout=INTAKE_IDLE)
+            except asyncio.TimeoutError:
+                # Requests can arrive after the wait timed out, but before this task ends
+                if not self.incoming:
+                    return
+                continue
+            try:
+                self._add_requests(requests)
+                if self.is_connected:
+                    self.play()
+            except Exception:
+                logging.exception('Could not add %d requests', len(requests))
+
+    def _add_requests(self, requests):
         if self._mode is GuildPlayerMode.SINGLE:
+            self._cancel_prefetch()
             self.requests.clear()
-            self.requests.add(request)
+            self.requests.add(requests[-1])
             self.skip()
         else:
-            self.requests.add(request)
+            self.requests.extend(requests)
+            # If one became the upcoming song, it wasn't prefetched yet
+            if self.is_playing and not self._prefetch_task:
+                self._prefetch_upcoming(self.requests.current)
 
     def play(self):
         """Tells the GuildPlayer to begin playing. 
@@ -157,22 +296,104 @@ class GuildPlayer:
         asyncio.ensure_future(self._start_playing())
 
     def skip(self):
-        "Tells the player to stop playing the current song and play the next"
+        '''Tells the player to stop playing the current song and play the next.
+        The current song is faded out first so that it doesn't click.
+        A prefetched source is kept, as its for the song that plays next'''
         self.skip_signal.set() # prevents looping
-        if self.voice_client:
+        self._end_source()
+
+    def seek(self, seconds):
+        '''Restarts the current song seconds in. Its source is opened again from its stream url,
+        without extracting it again. Returns false if nothing is playing'''
+        current = self.requests.current
+        if not self._tracked or not current or not self.voice_client:
+            return False
+
+        seconds = max(0.0, seconds)
+        if current.song.duration:
+            seconds = min(seconds, current.song.duration)
+        self._seek_to = seconds
+
+        # The upcoming song is prefetched relative to the end of this one, which moved
+        self._track_started = asyncio.get_event_loop().time() - seconds
+        if not self._prefetched:
+            self._prefetch_upcoming(current)
+
+        self._end_source()
+        return True
+
+    def _end_source(self):
+        "Stops the playing source. Its faded out first so that it doesn't click"
+        source = self._volume_source
+        if source:
+            source.fade_out(SKIP_FADE_FRAMES)
+            # If the source isn't being read the fade never ends, so make sure it stops
+            delay = SKIP_FADE_FRAMES * 0.02 + 0.2
+            asyncio.get_event_loop().call_later(delay, self._stop_source, source)
+        elif self.voice_client:
             self.voice_client.stop()
 
     def stop(self):
         "Tells the player to stop playing entirely. This does not clear the list"
+        self._cancel_prefetch()
         self.stop_signal.set()
         if self.voice_client:
             self.voice_client.stop()
 
     def clear(self):
-        "Clears the request list. Stops playback"
+        "Clears the request list and the requests yet to be added to it. Stops playback"
         self.stop()
+        self.incoming.clear()
         self.requests.clear()
 
+    def shuffle(self):
+        "Shuffles the upcoming requests"
+        self.requests.shuffle_queue()
+        self._queue_changed()
+
+    def remove(self, position):
+        "Removes the upcoming request at position (0 being the next) and returns it"
+        request = self.requests.remove_at(position)
+        self._queue_changed()
+        return request
+
+    def move(self, position, new_position):
+        "Moves the upcoming request at position to new_position"
+        self.requests.move(position, new_position)
+        self._queue_changed()
+
+    def jump(self, position):
+        "Skips to the upcoming request at position, keeping the ones before it queued. Returns it"
+        request = self.requests.jump_to(position)
+        self._queue_changed()
+        self.skip()
+        return request
+
+    def remove_user(self, user):
+        "Removes every request made by user. Returns how many were removed"
+        removed = self.requests.remove_by_user(user)
+        self._queue_changed()
+        return removed
+
+    def dedupe(self):
+        "Removes requests for the same song as another. Returns how many were removed"
+        removed = self.requests.dedupe()
+        self._queue_changed()
+        return removed
+
+    def _queue_changed(self):
+        "Prefetches the upcoming request again, unless it was already prefetched"
+        if not self.is_playing:
+            return
+        if self._prefetched and self._prefetched[0] is self.requests.peek():
+            return
+        self._prefetch_upcoming(self.requests.current)
+
+    def _stop_source(self, source):
+        "Stops playback if source is still what's playing"
+        if self._volume_source is source and self.voice_client:
+            self.voice_client.stop()
+
     def __len__(self):
         return len(self.requests)
 
@@ -190,8 +411,22 @@ class GuildPlayer:
         while self.is_connected and not self.stop_signal.is_set():
             song = self.requests.next()
             if not song: break
+            self.skip_signal.clear()
+            self._check_encoder()
+            self._seek_to = None
+            self._tracked = None
 
             try:
+                # Songs from playlists are only resolved once they're reached.
+                # Cached clips don't need a stream url at all
+                if not (self.clip_cache and self.clip_cache.path_for(song.song)):
+                    await self.loader.resolve(song.song)
+                if self.skip_signal.is_set() or self.stop_signal.is_set():
+                    continue
+                source = self._take_prefetched(song)
+                self._track_started = asyncio.get_event_loop().time()
+                self._prefetch_upcoming(song)
+
                 print('playing {}'.format(song.title.encode('utf8')))
 
                 # notify the request channel that the song is playing
@@ -206,10 +441,11 @@ class GuildPlayer:
                 if song.loop:
                     # If loop: keep playing until a stop OR skip signal is set
                     while not self.stop_signal.is_set() and not self.skip_signal.is_set():
-                        await self._play_song(song)
+                        await self._play_request(song, source)
+                        source = None
                     self.skip_signal.clear()
                 else:
-                    await self._play_song(song)
+                    await self._play_request(song, source)
 
             except:
                 # We have to handle it here as we still need to keep playing songs
@@ -219,14 +455,117 @@ class GuildPlayer:
                 await song.request_channel.send(msg_text)
 
         self.is_playing = False
+        self.last_active = time.monotonic()
+        self._cancel_prefetch()
 
         # Start the disconnect from voice channel timeout
-        timeout_coro = self._wait_timeout(self.inactivity_timeout_length)
-        self.inactivity_timeout = asyncio.ensure_future(timeout_coro)
+        self._start_inactivity_timeout()
+
+    def _prefetch_upcoming(self, current):
+        '''Starts preparing the request after current in the background, so its ready when reached.
+
+        The song is always resolved. In LINEAR mode its stream is also opened shortly before
+        current ends, so that its already decoding ahead when reached and there is no gap.
+        '''
+        self._cancel_prefetch()
+        upcoming = self.requests.peek()
+        if not upcoming:
+            return
 
-    async def _play_song(self, song, after=None):
-        '''This is a coroutine. Plays the contents of the song over audio.
-        Will reset the timeout, and start a timeout after the song completes
+        if self._mode is not GuildPlayerMode.LINEAR or current.loop:
+            self._prefetch_task = asyncio.ensure_future(self._prefetch(upcoming, None))
+            return
+
+        # Waiting until near the end keeps the connection from idling out
+        delay = 0
+        if current.song.duration:
+            elapsed = asyncio.get_event_loop().time() - self._track_started
+            delay = max(0, current.song.duration - elapsed - PREFETCH_LEAD)
+        self._prefetch_task = asyncio.ensure_future(self._prefetch(upcoming, delay))
+
+    async def _prefetch(self, request, delay):
+        '''This is a coroutine. Resolves the request, and if delay is not None,
+        starts its source after delay seconds'''
+        try:
+            await self.loader.resolve(request.song)
+            if delay is None:
+                return
+
+            await asyncio.sleep(delay)
+            if self.clip_cache and self.clip_cache.path_for(request.song):
+                return
+            await self.loader.resolve(request.song)
+            gain = self.volume / 100 * (self.loudness.gain_for(request.song) if self.loudness else 1.0)
+            self._prefetched = (request, self._open_stream(request.source, gain))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # It will be retried when the song is reached, which reports the error
+            logging.exception('Could not prefetch upcoming song %s', request.url)
+
+    def _take_prefetched(self, request):
+        "Returns the prefetched source if its for the request, otherwise returns None"
+        prefetched = self._prefetched
+        self._prefetched = None
+        self._cancel_prefetch()
+
+        if not prefetched:
+            return None
+        if prefetched[0] is not request:
+            prefetched[1].cleanup()
+            return None
+        return prefetched[1]
+
+    def _cancel_prefetch(self):
+        "Stops any prefetching and closes the prefetched source"
+        if self._prefetch_task:
+            self._prefetch_task.cancel()
+            self._prefetch_task = None
+        if self._prefetched:
+            self._prefetched[1].cleanup()
+            self._prefetched = None
+
+    async def _play_request(self, song, source=None):
+        '''This is a coroutine. Plays a request through _play_song, from the start.
+
+        If ffmpeg produced no audio at all, the stream url most likely expired (403),
+        so its resolved again and played once more. If the stream ends well before
+        the song's duration, its resumed from where it stopped, up to MAX_RESUMES times.
+        Seeking restarts the song at the requested offset.
+        '''
+        offset = 0.0
+        resumes = 0
+        retried = False
+        while True:
+            frames = await self._play_song(song, source, offset=offset)
+            source = None
+            if self.stop_signal.is_set() or self.skip_signal.is_set():
+                return
+
+            if self._seek_to is not None:
+                offset, self._seek_to = self._seek_to, None
+                continue
+
+            if not frames:
+                if retried:
+                    return
+                retried = True
+                logging.info('No audio received for %s, retrying with a new stream url', song.url)
+                await self.loader.resolve(song.song, force=True)
+                continue
+
+            offset += frames * 0.02
+            duration = song.song.duration
+            if not duration or offset >= duration - RESUME_TOLERANCE or resumes >= MAX_RESUMES:
+                return
+            resumes += 1
+            logging.info('Stream of %s ended at %.1f of %d seconds, resuming it', song.url, offset, duration)
+
+    async def _play_song(self, song, source=None, *, offset=0.0):
+        '''This is a coroutine. Plays the contents of the song over audio, starting offset seconds in.
+        If a source is given (like a prefetched one) its played instead of opening the song.
+        Will reset the timeout, and start a timeout after the song completes.
+        Returns the number of frames that were played.
         '''
 
         # If there is a player_timeout, cancel. If its already cancelled it has no effect
@@ -249,14 +588,68 @@ class GuildPlayer:
             # Going to keep them here to do more research on them later
             ##    before_options="-reconnect 1 -reconnect_at_eof 1 -reconnect_streamed 1 -reconnect_delay_max 2")
 
-            source = discord.FFmpegPCMAudio(song.source)
-            source = discord.PCMVolumeTransformer(source)
-            source.volume = self.volume / 100
-
-            self.voice_client.play(source, after=after)
+            # A cached clip knows its source's loudness, even once the LoudnessCache forgot it
+            clip_gain = not source and self.clip_cache and self.clip_cache.gain_of(song.song)
+            self._song_gain = self.loudness.gain_for(song.song) if self.loudness else 1.0
+            if clip_gain:
+                # Cached clips were normalized when they were encoded, so at 100% they're sent as they are
+                self._song_gain /= clip_gain
+            gain = self.volume / 100 * self._song_gain
+
+            source = source or self._open_source(song.song, gain, offset)
+            tracked = TrackedSource(source)
+            if not source.is_opus():
+                self._volume_source = GainTransformer(tracked, gain)
+            self._offset = offset
+            self._tracked = tracked
+
+            self.voice_client.play(self._volume_source or tracked, after=after)
+            # Resumes and seeks aren't new plays. Cached clips are already normalized,
+            # so only the stream tells how loud the song is
+            if self.loudness and not offset:
+                self.loudness.measure(song.song, song.source)
+            if self.clip_cache and not offset:
+                self.clip_cache.record_play(song.song)
 
             # wait until the player is done (triggered by 'after')
             await stop_event.wait()
+            self._volume_source = None
+            return tracked.frames
+
+    def _open_source(self, song, gain, offset=0.0):
+        '''Returns the best available AudioSource for the song, to be played at gain from offset seconds in.
+
+        Cached clips are played from memory, then from disk, and only otherwise from the stream url.
+        Opus sources are only used at a gain of 1, as it can't be applied to them.
+        '''
+        if not self.clip_cache:
+            return self._open_stream(song.source, gain, offset)
+
+        passthrough = gain == 1.0
+        start_frame = int(offset / 0.02)
+        clip = self.clip_cache.memory_clip(song, opus=passthrough)
+        if clip:
+            return MemoryAudioSource(clip, start_frame)
+
+        path = self.clip_cache.path_for(song)
+        if path and passthrough:
+            return OggOpusSource(path, start_frame)
+        return self._open_stream(path or song.source, gain, offset)
+
+    def _open_stream(self, input, gain, offset=0.0):
+        '''Opens input through the SharedStreams, starting offset seconds in.
+        Its Opus encoded at gain by ffmpeg if encoding is offloaded'''
+        if self.offload_encoding:
+            bitrate = self.encoder.bitrate if self.encoder else 128
+            return self.streams.open(input, gain=gain, offset=offset, bitrate=bitrate)
+        return self.streams.open(input, offset=offset)
+
+    def _start_inactivity_timeout(self):
+        "Starts the timeout to disconnect, replacing any that was running"
+        if self.inactivity_timeout:
+            self.inactivity_timeout.cancel()
+        timeout_coro = self._wait_timeout(self.inactivity_timeout_length)
+        self.inactivity_timeout = asyncio.ensure_future(timeout_coro)
 
     async def _wait_timeout(self, length):
         '''This is a coroutine. Starts the timeout for the player to disconnect.'''
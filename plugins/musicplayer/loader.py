@@ -1,49 +1,97 @@
 import asyncio
-import youtube_dl
-from youtube_dl.utils import DownloadError
-import config
 
+from .extractor import ExtractorPool
 from .song import Song
+from .songcache import normalize_lookup
+
+class _Flight:
+    "An extraction in progress, shared by every caller waiting on it"
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
 
 class Loader:
-    '''Retrieves song data via youtube dl'''
+    '''Retrieves song data via youtube dl
+
+    Extraction runs in an ExtractorPool. If a SongCache is given, single
+    songs are served from it. When a cached stream url expires only the
+    stream url is re-resolved, from the page url.
+
+    Identical lookups made while one is already running wait on the same
+    extraction. Once every caller waiting on an extraction was cancelled, it's
+    cancelled too. That only stops it if it was still queued for a worker: one
+    a worker already started runs to the end, and its result is thrown away.
+    '''
+
+    def __init__(self, *, cache=None, pool=None):
+        self.cache = cache
+        self.pool = pool or ExtractorPool()
+        self._flights = {}
 
     async def load_song(self, lookup : str):
-        results = await self._load_from_url(lookup, noplaylist=True)
-        title, source = results[0]
-        return Song(title, lookup, source)
+        entry = self.cache.get(lookup) if self.cache else None
+        if entry and entry.is_fresh(self.cache.margin):
+            return Song(entry.title, entry.url, entry.source, entry.duration)
+
+        # A stale entry still knows its page url, which is cheaper to resolve than a search
+        target = entry.url if entry else lookup
+        results = await self._load_from_url(target, noplaylist=True)
+        title, url, source, duration = results[0]
+        if entry:
+            title = entry.title
 
-    async def load_playlist(self, lookup : str):
-        results = await self._load_from_url(lookup)
-        return [Song(title, lookup, source) for (title, source) in results]
+        if self.cache:
+            self.cache.put(lookup, title, url, source, duration)
+        return Song(title, url, source, duration)
 
-    async def _load_from_url(self, url: str, *, noplaylist=False):
+    async def load_playlist(self, lookup : str, *, lazy=True):
+        '''Retrieves all songs in a playlist.
+
+        If lazy, only the titles and page urls are retrieved, and every song
+        has to be resolved right before playing it.
+        '''
+        results = await self._load_from_url(lookup, flat=lazy)
+        return [Song(*result) for result in results]
+
+    async def resolve(self, song : Song, *, force=False):
+        '''Fills in the song's stream url if its missing or about to expire.
+        If force is set, the stream url is always retrieved again'''
+        margin = self.cache.margin if self.cache else 0
+        if not force and not song.is_stale(margin):
+            return
+
+        if force and self.cache:
+            self.cache.invalidate(song.url)
+        resolved = await self.load_song(song.url)
+        song.source = resolved.source
+        if song.duration is None:
+            song.duration = resolved.duration
+
+    async def _load_from_url(self, url: str, *, noplaylist=False, flat=False):
         '''Retrieves one or more songs for a url. If its a playlist, returns multiple
 
-        The results are (title, source) pairs
+        The results are (title, url, source, duration) tuples
         '''
+        key = (normalize_lookup(url), noplaylist, flat)
+        flight = self._flights.get(key)
+        if not flight:
+            task = asyncio.ensure_future(self.pool.extract(url, noplaylist=noplaylist, flat=flat))
+            flight = self._flights[key] = _Flight(task)
+            task.add_done_callback(lambda _: self._end_flight(key, flight))
+
+        flight.waiters += 1
+        try:
+            # Shielded so that one caller being cancelled doesn't cancel the others
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                self._end_flight(key, flight)
+                # Frees up the pool if the job hadn't started, a running one can't be stopped
+                flight.task.cancel()
 
-        ydl = youtube_dl.YoutubeDL({
-            'format': 'bestaudio/best',
-            'noplaylist': noplaylist,
-            'ignoreerrors': True,
-            'nocheckcertificate': True,
-            'logtostderr': False,
-            'quiet': True
-        })
-
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self._extract_songs, ydl, url)
-
-    def _extract_songs(self, ydl: youtube_dl.YoutubeDL, url: str):
-        info = ydl.extract_info(url, download=False)
-        if not info:
-            raise DownloadError('Data could not be retrieved')
-            
-        if '_type' in info and info['_type'] == 'playlist':
-            entries = info['entries']
-        else:
-            entries = [info]
-
-        results = [(e['title'], e['url']) for e in entries]
-        return results
+    def _end_flight(self, key, flight):
+        # A newer flight for the same key may have started after this one was abandoned
+        if self._flights.get(key) is flight:
+            del self._flights[key]
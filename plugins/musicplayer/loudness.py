@@ -0,0 +1,125 @@
+import asyncio
+import collections
+import json
+import os
+import re
+import subprocess
+import time
+import logging
+
+from core.filelock import locked
+from .songcache import normalize_lookup
+
+_INTEGRATED_RE = re.compile(r'I:\s+(-?[\d.]+) LUFS')
+
+class LoudnessCache:
+    '''Measures how loud songs are and remembers it by url, to normalize their volume.
+
+    Songs are measured in the background the first time they're played, so
+    that first play is at unity gain. Later plays get the gain that brings
+    them to target (in LUFS), limited to between min_gain and max_gain dB.
+    '''
+
+    max_entries = 50000
+    save_interval = 60
+
+    def __init__(self, path, *, target=-18.0, min_gain=-24.0, max_gain=6.0, max_duration=600, concurrency=2):
+        self.path = path
+        self.target = target
+        self.min_gain = min_gain
+        self.max_gain = max_gain
+        self.max_duration = max_duration
+
+        self._loudness = collections.OrderedDict()
+        self._measuring = set()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._saved_at = 0
+        self._load()
+
+    def gain_for(self, song):
+        '''Returns the linear gain that normalizes the song. Sets the song's loudness if known,
+        and otherwise starts measuring it from input (its stream url or a local file)'''
+        if song.loudness is None:
+            song.loudness = self._loudness.get(normalize_lookup(song.url))
+        if song.loudness is None:
+            return 1.0
+
+        gain_db = max(self.min_gain, min(self.max_gain, self.target - song.loudness))
+        return 10 ** (gain_db / 20)
+
+    def measure(self, song, input):
+        "Starts measuring the song's loudness from input in the background, if its not known yet"
+        key = normalize_lookup(song.url)
+        if song.loudness is not None or key in self._loudness or key in self._measuring or not input:
+            return
+        self._measuring.add(key)
+        asyncio.ensure_future(self._measure(key, input))
+
+    async def _measure(self, key, input):
+        try:
+            async with self._semaphore:
+                loop = asyncio.get_event_loop()
+                loudness = await loop.run_in_executor(None, self._analyze, input)
+        except Exception:
+            logging.exception('Could not measure loudness of %s', key)
+            return
+        finally:
+            self._measuring.discard(key)
+
+        if loudness is None:
+            return
+        self._loudness[key] = loudness
+        while len(self._loudness) > self.max_entries:
+            self._loudness.popitem(last=False)
+        if time.time() - self._saved_at > self.save_interval:
+            self._save()
+
+    def _analyze(self, input):
+        "Blocks while ffmpeg measures the integrated loudness of input. Returns LUFS or None"
+        result = subprocess.run([
+            'ffmpeg', '-nostdin', '-hide_banner', '-nostats',
+            '-i', input, '-t', str(self.max_duration), '-vn',
+            '-af', 'ebur128=framelog=quiet', '-f', 'null', '-'
+        ], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=300)
+
+        # The summary is printed last
+        matches = _INTEGRATED_RE.findall(result.stderr.decode('utf8', 'replace'))
+        if not matches:
+            return None
+        loudness = float(matches[-1])
+        # Silence measures as -70, which would mean maximum gain on nothing
+        return loudness if loudness > -70 else None
+
+    def _load(self):
+        self._loudness.update(self._read())
+
+    def _read(self):
+        "Returns the measurements saved on disk"
+        try:
+            with open(self.path, encoding='utf8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.exception('Could not read loudness cache at %s', self.path)
+            return {}
+
+    def _save(self):
+        self._saved_at = time.time()
+        with locked(self.path):
+            # Measurements other processes saved are kept, as older entries
+            loudness = collections.OrderedDict(self._read())
+            for key, value in self._loudness.items():
+                loudness.pop(key, None)
+                loudness[key] = value
+            while len(loudness) > self.max_entries:
+                loudness.popitem(last=False)
+            self._loudness = loudness
+
+            temp_path = self.path + '.tmp'
+            try:
+                with open(temp_path, 'w', encoding='utf8') as f:
+                    json.dump(self._loudness, f)
+                os.replace(temp_path, self.path)
+            except OSError:
+                logging.exception('Could not write loudness cache at %s', self.path)
@@ -0,0 +1,134 @@
+import array
+import asyncio
+import collections
+import subprocess
+import logging
+
+import discord
+
+from .sources import iter_ogg_packets
+
+class MemoryClip:
+    '''Audio held in a single bytes object, split into 20ms frames.
+
+    Opus clips keep the offset of every packet. PCM clips are 48KHz 16 bit
+    stereo, so every frame has the same size.
+    '''
+
+    def __init__(self, data : bytes, offsets=None):
+        self.data = data
+        self.offsets = offsets
+        self.is_opus = offsets is not None
+
+    def __len__(self):
+        "Returns the number of frames"
+        if self.is_opus:
+            return len(self.offsets) - 1
+        return len(self.data) // discord.opus.Encoder.FRAME_SIZE
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def bounds(self, index):
+        "Returns the start and end position of the frame at index"
+        if self.is_opus:
+            return self.offsets[index], self.offsets[index + 1]
+        frame_size = discord.opus.Encoder.FRAME_SIZE
+        return index * frame_size, (index + 1) * frame_size
+
+    @classmethod
+    def from_ogg(cls, path):
+        "Blocks while loading an Ogg Opus file"
+        packets = []
+        offsets = array.array('L', [0])
+        with open(path, 'rb') as f:
+            for packet in iter_ogg_packets(f):
+                packets.append(packet)
+                offsets.append(offsets[-1] + len(packet))
+        return cls(b''.join(packets), offsets)
+
+    @classmethod
+    def from_ffmpeg(cls, path, max_bytes):
+        '''Blocks while decoding a file to PCM with ffmpeg.
+        Returns None if the result would be larger than max_bytes'''
+        process = subprocess.Popen([
+            'ffmpeg', '-nostdin', '-loglevel', 'error',
+            '-i', path,
+            '-f', 's16le', '-ar', '48000', '-ac', '2', 'pipe:1'
+        ], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        try:
+            data = process.stdout.read(max_bytes + 1)
+        finally:
+            process.kill()
+            process.wait()
+
+        if len(data) > max_bytes:
+            return None
+        # A partial frame at the end can't be played
+        return cls(data[:len(data) - len(data) % discord.opus.Encoder.FRAME_SIZE])
+
+class MemoryClipCache:
+    '''Keeps short clips in memory, so that they can be played without ffmpeg or the disk.
+
+    Clips are loaded in the background from the ClipCache's files, as Opus for
+    when they're played unmodified, or as PCM for when volume has to be applied.
+    The least recently played clips are dropped when over max_bytes.
+    '''
+
+    def __init__(self, *, max_bytes=64*1024*1024, max_clip_bytes=4*1024*1024):
+        self.max_bytes = max_bytes
+        self.max_clip_bytes = max_clip_bytes
+        self.total_bytes = 0
+        self._clips = collections.OrderedDict()
+        self._loading = set()
+
+        # Clips that were too large, so they aren't decoded again on every play
+        self._rejected = set()
+
+    def get(self, key, *, opus):
+        "Returns the MemoryClip for the key, or None if its not loaded"
+        key = (key, opus)
+        clip = self._clips.get(key)
+        if clip:
+            self._clips.move_to_end(key)
+        return clip
+
+    def load(self, key, path, *, opus):
+        "Starts loading the clip at path in the background, if its not loaded yet"
+        key = (key, opus)
+        if key in self._clips or key in self._loading or key in self._rejected:
+            return
+        self._loading.add(key)
+        asyncio.ensure_future(self._load(key, path, opus))
+
+    def discard(self, key):
+        "Drops both versions of a clip, like when its file is evicted"
+        for opus in (True, False):
+            clip = self._clips.pop((key, opus), None)
+            if clip:
+                self.total_bytes -= clip.size
+            self._rejected.discard((key, opus))
+
+    async def _load(self, key, path, opus):
+        loop = asyncio.get_event_loop()
+        try:
+            if opus:
+                clip = await loop.run_in_executor(None, MemoryClip.from_ogg, path)
+            else:
+                clip = await loop.run_in_executor(None, MemoryClip.from_ffmpeg, path, self.max_clip_bytes)
+        except Exception:
+            logging.exception('Could not load clip %s into memory', path)
+            return
+        finally:
+            self._loading.discard(key)
+
+        if not clip or clip.size > self.max_clip_bytes:
+            self._rejected.add(key)
+            return
+
+        self._clips[key] = clip
+        self.total_bytes += clip.size
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self._clips.popitem(last=False)
+            self.total_bytes -= evicted.size
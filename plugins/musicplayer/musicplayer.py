@@ -7,12 +7,23 @@ from discord.ext import commands
 
 from .guildplayer import GuildPlayer, GuildPlayerMode
 from .loader import Loader
+from .extractor import ExtractorPool
 from .song import Song
+from .songcache import SongCache
+from .clipcache import ClipCache
+from .memorycache import MemoryClipCache
+from .sharedstream import SharedStreams
+from .loudness import LoudnessCache
+from .encoder import EncoderTuner
 
 from core import checks, ex_str
 
 import logging
 import functools
+import time
+
+# How many tracks list_cmd shows at once
+LIST_PAGE_SIZE = 10
 
 def voice_only(fn):
     """A decorator that modifies a cog function command to require a sender to be in a voice channel.
@@ -30,13 +41,95 @@ def voice_only(fn):
     return modified_fn
 
 
+def parse_time(text : str):
+    "Returns the seconds in a timestamp like 83, 1:23 or 1:01:23. Raises BadArgument if its not one"
+    try:
+        seconds = 0.0
+        for part in text.split(':'):
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        raise commands.BadArgument('Invalid timestamp {}'.format(text))
+    return seconds
+
+def format_time(seconds):
+    "Formats seconds as a timestamp like 1:23"
+    minutes, seconds = divmod(int(seconds), 60)
+    return '{}:{:02}'.format(minutes, seconds)
+
+
 class MusicPlayerPlugin(commands.Cog):
     def __init__(self, bot, tagdb):
         self.bot = bot
-        self.loader = Loader()
+        self.loader = Loader(
+            cache=SongCache('database/songcache.json', max_entries=config.song_cache_size),
+            pool=ExtractorPool(size=config.extractor_workers, timeout=config.extractor_timeout))
+        self.loudness = None
+        if config.loudness_target is not None:
+            self.loudness = LoudnessCache('database/loudness.json', target=config.loudness_target)
+        self.clip_cache = ClipCache(
+            'database/clips',
+            memory=MemoryClipCache(max_bytes=config.memory_clip_cache_size_mb * 1024 * 1024),
+            loudness=self.loudness,
+            max_bytes=config.clip_cache_size_mb * 1024 * 1024,
+            promote_after=config.clip_cache_promote_after,
+            max_duration=config.clip_cache_max_duration)
+        self.streams = SharedStreams(
+            read_ahead=config.stream_buffer_frames,
+            prebuffer=config.stream_prebuffer_frames)
+        self.encoder_tuner = EncoderTuner(budget_ms=config.encode_budget_ms)
+        self._tuning = bot.loop.create_task(self.encoder_tuner.run())
         self.players = {}
         self.tagdb = tagdb
 
+        # Voice channel id -> the player connected to it, and how many non-bot members are in it
+        self.channel_players = {}
+        self.listener_counts = {}
+
+        # Players that sit idle are dropped, keeping only (volume, mode) for when they're needed again
+        self.settings = {}
+        self._evictor = bot.loop.create_task(self._evict_idle_players())
+
+        # The song being loaded for a guild in SINGLE mode, so a newer play can abandon it
+        self.pending_loads = {}
+
+    def cog_unload(self):
+        self._evictor.cancel()
+        self._tuning.cancel()
+        self.loader.pool.shutdown()
+        if self.loader.cache:
+            self.loader.cache.save()
+
+    async def _evict_idle_players(self):
+        "This is a coroutine. Periodically removes players that have been idle for player_idle_timeout"
+        while True:
+            await asyncio.sleep(60)
+            now = time.monotonic()
+            for guild_id, player in list(self.players.items()):
+                idle_time = now - player.last_active
+                if player.is_idle and idle_time > config.player_idle_timeout and guild_id not in self.pending_loads:
+                    self.settings[guild_id] = (player.volume, player.mode)
+                    if player.inactivity_timeout:
+                        player.inactivity_timeout.cancel()
+                    del self.players[guild_id]
+
+    def stats(self):
+        "Returns the music player's stats, for the cluster stats"
+        streams, underruns, overruns = self.streams.stats()
+        return {
+            'players': len(self.players),
+            'playing': sum(1 for p in self.players.values() if p.is_playing),
+            'queued': sum(len(p) for p in self.players.values()),
+            'streams': streams,
+            'underruns': underruns,
+            'overruns': overruns,
+            'encode_ms': round(self.encoder_tuner.load_ms, 2),
+        }
+
+    def queue_capacity(self):
+        "Returns how many more requests can be queued across all guilds"
+        queued = sum(len(p) + len(p.incoming) for p in self.players.values())
+        return max(0, config.max_queued_requests - queued)
+
     # Disconnect the bot if there's no one to listen
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before, after):
@@ -46,27 +139,76 @@ class MusicPlayerPlugin(commands.Cog):
         if before.channel is after.channel:
             return
 
-        player = self.player_for(member.guild)
+        # The bot itself was moved or disconnected, possibly by someone else
+        if member.id == self.bot.user.id:
+            player = self.players.get(member.guild.id)
+            if player:
+                self.channel_changed(player, before.channel, after.channel)
+                # The new channel can have another bitrate
+                player.tune_encoder()
+            return
 
-        # If the channel is uninvolved or disconnected, we skip
-        if not player.is_connected or before.channel != player.channel:
+        if member.bot:
             return
 
-        # Disconnect if the player's channel is empty of regular users
-        all_members = player.channel.members
-        regular_members = filter(lambda v: not v.bot, all_members)
-        if not next(regular_members, None):
-            await player.disconnect()
+        if after.channel and after.channel.id in self.listener_counts:
+            self.listener_counts[after.channel.id] += 1
+
+        # If the channel is uninvolved, we skip
+        if not before.channel or before.channel.id not in self.listener_counts:
+            return
+
+        self.listener_counts[before.channel.id] -= 1
+        if self.listener_counts[before.channel.id] > 0:
+            return
+
+        # Disconnect if the player's channel is empty of regular users.
+        # The count is only an estimate, so make sure before leaving
+        count = self._count_listeners(before.channel)
+        self.listener_counts[before.channel.id] = count
+        if not count:
+            await self.channel_players[before.channel.id].disconnect()
+
+    def channel_changed(self, player, old_channel, new_channel):
+        "Keeps the voice channel indexes up to date. Used as every player's on_channel_change"
+        if old_channel:
+            self.channel_players.pop(old_channel.id, None)
+            self.listener_counts.pop(old_channel.id, None)
+        if new_channel:
+            self.channel_players[new_channel.id] = player
+            self.listener_counts[new_channel.id] = self._count_listeners(new_channel)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        "Triggered when a channel's settings change. The encoder follows the voice channel's bitrate"
+        player = self.channel_players.get(after.id)
+        if player and getattr(before, 'bitrate', None) != getattr(after, 'bitrate', None):
+            player.tune_encoder()
+
+    def _count_listeners(self, channel):
+        return sum(1 for m in channel.members if not m.bot)
 
     def player_for(self, guild):
         'Retrieves or creates a GuildPlayer based on the given context'
         try:
-            return self.players[guild.id]
+            player = self.players[guild.id]
+            # Its about to be used, so its not evicted while the command loads or connects
+            player.last_active = time.monotonic()
+            return player
         except KeyError:
+            volume, mode = self.settings.pop(guild.id, (config.default_volume, GuildPlayerMode.SINGLE))
             player = GuildPlayer(
                 guild,
-                volume=config.default_volume,
+                self.loader,
+                streams=self.streams,
+                clip_cache=self.clip_cache,
+                loudness=self.loudness,
+                encoder_tuner=self.encoder_tuner,
+                on_channel_change=self.channel_changed,
+                offload_encoding=config.offload_encoding,
+                volume=volume,
                 inactivity_timeout=config.connection_timeout)
+            player.mode = mode
             self.players[guild.id] = player
             return player
 
@@ -77,6 +219,30 @@ class MusicPlayerPlugin(commands.Cog):
         player.volume = int(volume)
         await ctx.send("Updated guild's volume to " + str(player.volume) + "%")
 
+    @commands.command(name='audiostats')
+    @commands.check(checks.is_owner_or_admin)
+    async def audiostats_cmd(self, ctx):
+        "Shows how the audio buffers are holding up. Can only be used by guild admins"
+        streams, underruns, overruns = self.streams.stats()
+        await ctx.send(
+            f'{streams} streams are decoding, buffering {self.streams.read_ahead} frames ahead.\n'
+            f'Underruns: {underruns} | Overruns: {overruns}')
+
+    @commands.command(name='encoding')
+    async def encoding_cmd(self, ctx):
+        "Shows how audio is encoded for this guild"
+        player = self.player_for(ctx.guild)
+        tuner = self.encoder_tuner
+        load = f'Encoding load: {tuner.load_ms:.2f}ms per 20ms frame (budget {tuner.budget_ms}ms)'
+
+        encoder = player.encoder
+        if not encoder:
+            await ctx.send(f'Not connected to a voice channel.\n{load}')
+            return
+        channels = 'mono' if encoder.channels == 1 else 'stereo'
+        await ctx.send(
+            f'Bitrate: {encoder.bitrate}kbps | Complexity: {encoder.complexity} | {channels}\n{load}')
+
     @commands.command(name='play', aliases=['p'])
     @voice_only
     async def play_cmd(self, ctx, url : str=None, *args):
@@ -100,17 +266,32 @@ class MusicPlayerPlugin(commands.Cog):
 
             if url:
                 # Try to load a tag, if it fails it passes through
-                url = self.tagdb.try_get(ctx.author.id, url, default=url)
+                url = await self.tagdb.try_get(ctx.author.id, url, default=url, guild_id=ctx.guild.id)
                 logging.info("Playing {}".format(url))
 
-                song = await self.loader.load_song(url)
-                player.request_song(song, ctx.author, ctx.channel, loop=loop)                
+                if player.mode is GuildPlayerMode.LINEAR and not self.queue_capacity():
+                    await ctx.send("Too many songs are queued right now.")
+                    return
+
+                # Connecting doesn't depend on the song, so it happens while its loaded
+                connecting = asyncio.ensure_future(player.connect(ctx.author.voice.channel))
+                try:
+                    song = await self._load_superseding(player, url)
+                except BaseException:
+                    await self._finish_connecting(connecting)
+                    raise
+                await connecting
+                # The player starts playing once its taken in
+                await player.submit([song], ctx.author, ctx.channel, loop=loop)
             elif not len(player):
                 await ctx.send("There is nothing to play.")
                 return
+            else:
+                await player.connect(ctx.author.voice.channel)
+                player.play()
 
-            await player.connect(ctx.author.voice.channel)
-            player.play()
+        except asyncio.CancelledError:
+            logging.info("Abandoned loading {}, a newer song was requested".format(url))
 
         except youtube_dl.utils.DownloadError as ex:
             message = 'Failed to download video: ' + ex_str(ex)
@@ -124,6 +305,33 @@ class MusicPlayerPlugin(commands.Cog):
 
             await ctx.send("Error while trying to connect or play audio")
 
+    async def _finish_connecting(self, connecting):
+        '''This is a coroutine. Waits for a connect that is no longer needed, as loading failed.
+        The connection is kept, and the player's inactivity timeout disconnects it if nothing plays'''
+        try:
+            await connecting
+        except Exception:
+            logging.exception('Error while connecting')
+
+    async def _load_superseding(self, player, url):
+        '''This is a coroutine. Loads a song for the player.
+        In SINGLE mode, a song still loading for the same guild is abandoned,
+        raising CancelledError for whoever was waiting on it. Its extraction only
+        stops if it hadn't reached a worker yet (see Loader)'''
+        guild_id = player.guild.id
+        if player.mode is GuildPlayerMode.SINGLE:
+            pending = self.pending_loads.get(guild_id)
+            if pending:
+                pending.cancel()
+
+        task = asyncio.ensure_future(self.loader.load_song(url))
+        self.pending_loads[guild_id] = task
+        try:
+            return await task
+        finally:
+            if self.pending_loads.get(guild_id) is task:
+                del self.pending_loads[guild_id]
+
     @commands.command(name='playlist')
     @voice_only
     async def playlist_cmd(self, ctx, url, *args):
@@ -133,18 +341,34 @@ class MusicPlayerPlugin(commands.Cog):
 
         try:
             # Try to load a tag, if it fails it passes through
-            url = self.tagdb.try_get(ctx.author.id, url, default=url)
+            url = await self.tagdb.try_get(ctx.author.id, url, default=url, guild_id=ctx.guild.id)
             logging.info("Playlist at {}".format(url))
 
-            songs = await self.loader.load_playlist(url)
             player = self.player_for(ctx.guild)
-            
-            await player.connect(ctx.author.voice.channel)
+            if not self.queue_capacity():
+                await ctx.send("Too many songs are queued right now.")
+                return
+
+            # Connecting doesn't depend on the playlist, so it happens while its loaded
+            connecting = asyncio.ensure_future(player.connect(ctx.author.voice.channel))
+            try:
+                songs = await self.loader.load_playlist(url)
+            except BaseException:
+                await self._finish_connecting(connecting)
+                raise
+            await connecting
+
+            capacity = self.queue_capacity()
+            if not capacity:
+                await ctx.send("Too many songs are queued right now.")
+                return
+            if len(songs) > capacity:
+                await ctx.send("Only queueing the first {} songs.".format(capacity))
+                songs = songs[:capacity]
+
             player.mode = GuildPlayerMode.LINEAR
 
-            for song in songs:
-                player.request_song(song, ctx.author, ctx.channel)
-            player.play()
+            await player.submit(songs, ctx.author, ctx.channel)
 
         except youtube_dl.utils.DownloadError as ex:            
             message = 'Failed to download video: ' + ex_str(ex)
@@ -170,6 +394,26 @@ class MusicPlayerPlugin(commands.Cog):
         "Skips to the next song in the queue"
         self.player_for(ctx.guild).skip()
 
+    @commands.command(name='seek')
+    @voice_only
+    async def seek_cmd(self, ctx, timestamp : str):
+        """Jumps to a time in the current song, like 1:23.
+        Use a + or - in front to move relative to where it is now, like +30."""
+        player = self.player_for(ctx.guild)
+        position = player.position
+        if position is None:
+            await ctx.send('Nothing is playing')
+            return
+
+        if timestamp[0] in '+-':
+            sign = 1 if timestamp[0] == '+' else -1
+            seconds = position + sign * parse_time(timestamp[1:])
+        else:
+            seconds = parse_time(timestamp)
+
+        if player.seek(seconds):
+            await ctx.send('Seeking to ' + format_time(max(0, seconds)))
+
     @commands.command(name='stop')
     @voice_only
     async def stop_cmd(self, ctx):
@@ -177,20 +421,88 @@ class MusicPlayerPlugin(commands.Cog):
         self.player_for(ctx.guild).stop()
 
     @commands.command(name='list')
-    async def list_cmd(self, ctx):
-        "Lists all loaded tracks"
+    async def list_cmd(self, ctx, page : int=1):
+        "Lists the upcoming tracks, a page at a time"
         player = self.player_for(ctx.guild)
         count = len(player)
         if not count:
             await ctx.send('The playlist is empty')
             return
 
-        message = f'{count} items are in the list.\n'
-        if count > 20:
-            message += 'These are the first 10.\n'
+        requests = player.requests
+        pages = max(1, -(-requests.upcoming // LIST_PAGE_SIZE))
+        page = max(1, min(page, pages))
+        start = (page - 1) * LIST_PAGE_SIZE
 
-        titles = [req.title for req in player]
-        titles = titles[0:10]
-        message += '```{}```'.format('\n'.join(titles))
+        message = f'{count} items are in the list. Page {page} of {pages}.\n'
+        if player.is_playing and requests.current:
+            message += f'Now playing: {requests.current.title}\n'
+
+        titles = [f'{start + i + 1}. {req.title}' for i, req in enumerate(requests.window(start, LIST_PAGE_SIZE))]
+        if titles:
+            message += '```{}```'.format('\n'.join(titles))
 
         await ctx.send(message)
+
+    @commands.command(name='remove')
+    @voice_only
+    async def remove_cmd(self, ctx, position : int):
+        "Removes a track from the queue, by its number in the list"
+        player = self.player_for(ctx.guild)
+        try:
+            request = player.remove(position - 1)
+        except IndexError:
+            await ctx.send('There is no track at that position')
+            return
+        await ctx.send(f'Removed {request.title}')
+
+    @commands.command(name='move')
+    @voice_only
+    async def move_cmd(self, ctx, position : int, new_position : int):
+        "Moves a track in the queue to another position"
+        player = self.player_for(ctx.guild)
+        try:
+            player.move(position - 1, new_position - 1)
+        except IndexError:
+            await ctx.send('There is no track at that position')
+
+    @commands.command(name='jump')
+    @voice_only
+    async def jump_cmd(self, ctx, position : int):
+        "Skips to a track in the queue. The tracks before it stay queued"
+        player = self.player_for(ctx.guild)
+        try:
+            player.jump(position - 1)
+        except IndexError:
+            await ctx.send('There is no track at that position')
+
+    @commands.command(name='removeuser')
+    @voice_only
+    async def removeuser_cmd(self, ctx, member : discord.Member=None):
+        "Removes every track requested by a user, by default yourself. Removing others' can only be done by guild admins"
+        member = member or ctx.author
+        if member.id != ctx.author.id:
+            await checks.is_owner_or_admin(ctx)
+
+        removed = self.player_for(ctx.guild).remove_user(member)
+        await ctx.send(f'Removed {removed} tracks requested by {member.name}')
+
+    @commands.command(name='dedupe')
+    @voice_only
+    async def dedupe_cmd(self, ctx):
+        "Removes tracks that are queued more than once"
+        removed = self.player_for(ctx.guild).dedupe()
+        await ctx.send(f'Removed {removed} duplicate tracks')
+
+    @commands.command(name='position')
+    async def position_cmd(self, ctx, member : discord.Member=None):
+        "Shows when the next track requested by a user, by default yourself, will play"
+        member = member or ctx.author
+        requests = self.player_for(ctx.guild).requests
+        position = requests.find(lambda req: req.request_user.id == member.id)
+        if position is None:
+            await ctx.send(f'{member.name} has no upcoming tracks')
+            return
+
+        request = requests.window(position, 1)[0]
+        await ctx.send(f'{request.title} is number {position + 1} in the list')
@@ -0,0 +1,262 @@
+import collections
+import threading
+import logging
+import time
+
+import discord
+
+from .sources import FFmpegOpusSource
+
+# Played in place of a frame that wasn't decoded in time
+SILENCE = bytes(discord.opus.Encoder.FRAME_SIZE)
+OPUS_SILENCE = b'\xf8\xff\xfe'
+
+class SharedStream:
+    '''Decodes an input with ffmpeg once, for every guild playing it.
+
+    Decoded PCM frames are read ahead on a separate thread and kept in memory,
+    up to max_frames, so that guilds that start the same input shortly after
+    can join and still play it from the start. Once more than that was decoded
+    nobody can join anymore, and frames are only kept until every subscriber
+    played them. Each subscriber reads at its own position. The source may be
+    Opus encoded, in which case frames are packets.
+
+    The frames decoded ahead also work as a jitter buffer, so that a stall in
+    ffmpeg or its input doesn't reach the voice connection until read_ahead
+    frames are used up. Underruns count the frames that weren't decoded in
+    time, and overruns the frames a subscriber missed by falling max_frames behind.
+    '''
+
+    # Seconds a started subscriber waits for a frame before silence is played instead
+    underrun_wait = 0.02
+
+    def __init__(self, registry, key, source : discord.AudioSource, *, max_frames, read_ahead, prebuffer=0):
+        self.registry = registry
+        self.key = key
+        self.max_frames = max_frames
+        self.read_ahead = read_ahead
+        self.prebuffer = min(prebuffer, read_ahead)
+        self.underruns = 0
+        self.overruns = 0
+
+        self._source = source
+        self.is_opus = source.is_opus()
+        self._silence = OPUS_SILENCE if self.is_opus else SILENCE
+        self._frames = collections.deque()
+        self._first = 0 # index of the first retained frame
+        self._finished = False
+        self._closed = False
+        self._subscribers = set()
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def joinable(self):
+        "Returns true if a new subscriber can still play this from the start"
+        return not self._closed and self._first == 0
+
+    def subscribe(self):
+        "Returns a new SharedStreamSource, or None if the stream can't be joined anymore"
+        with self._cond:
+            if not self.joinable:
+                return None
+            subscriber = SharedStreamSource(self)
+            self._subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        "Removes a subscriber. The stream is closed once it has none"
+        with self._cond:
+            self._subscribers.discard(subscriber)
+            if self._subscribers:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self.registry._remove(self)
+        self._source.cleanup()
+
+    def frame(self, subscriber):
+        '''Returns the subscriber's next frame, or b'' once the stream ends.
+
+        A subscriber first waits until prebuffer frames are decoded ahead of it. After
+        that, a frame that isn't decoded within underrun_wait is an underrun, and silence
+        is returned in its place so that the voice connection keeps its pace.
+        '''
+        with self._cond:
+            deadline = None
+            while True:
+                # Frames the subscriber fell too far behind on are gone, so it skips ahead
+                if subscriber.position < self._first:
+                    self.overruns += self._first - subscriber.position
+                    subscriber.position = self._first
+                index = subscriber.position - self._first
+                available = len(self._frames) - index
+                if self._finished or self._closed:
+                    break
+
+                if not subscriber.started:
+                    if available >= max(self.prebuffer, 1):
+                        subscriber.started = True
+                        break
+                    self._cond.wait()
+                    continue
+
+                if available > 0:
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + self.underrun_wait
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.underruns += 1
+                    subscriber.underruns += 1
+                    return self._silence
+                self._cond.wait(remaining)
+
+            if index >= len(self._frames):
+                return b''
+            data = self._frames[index]
+            subscriber.position += 1
+            self._trim()
+            self._cond.notify_all()
+            return data
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._closed and self._ahead() >= self.read_ahead:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+
+                data = self._source.read()
+
+                with self._cond:
+                    if not data:
+                        return
+                    self._frames.append(data)
+                    if len(self._frames) > self.max_frames:
+                        self._frames.popleft()
+                        self._first += 1
+                    self._trim()
+                    self._cond.notify_all()
+        except Exception:
+            logging.exception('Shared stream %s stopped decoding', self.key)
+        finally:
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+    def _trim(self):
+        "Drops the frames every subscriber played, once the stream can't be joined anymore"
+        if not self._first or not self._subscribers:
+            return
+        slowest = min(s.position for s in self._subscribers)
+        while self._first < slowest and self._frames:
+            self._frames.popleft()
+            self._first += 1
+
+    def _ahead(self):
+        "Returns how many frames were decoded past the furthest subscriber"
+        furthest = max((s.position for s in self._subscribers), default=0)
+        return self._first + len(self._frames) - furthest
+
+class SharedStreamSource(discord.AudioSource):
+    '''A guild's view of a SharedStream.
+
+    Frames are shared with the other subscribers, so volume has to be applied
+    by wrapping this, like with a GainTransformer. Streams encoded by ffmpeg
+    have their gain applied already.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+        self.started = False
+        # Frames of silence played because the next frame wasn't decoded in time
+        self.underruns = 0
+        self._done = False
+
+    def read(self):
+        return self.stream.frame(self)
+
+    def is_opus(self):
+        return self.stream.is_opus
+
+    def cleanup(self):
+        if not self._done:
+            self._done = True
+            self.stream.unsubscribe(self)
+
+class SharedStreams:
+    '''Opens SharedStreams, joining one already playing the same input when possible.
+
+    max_frames is how long after a stream starts another guild can still join it,
+    and until then how much decoded audio the stream keeps. read_ahead is how many
+    frames are decoded ahead of the furthest subscriber, and prebuffer how many
+    a subscriber waits for before it starts playing.
+    '''
+
+    def __init__(self, *, max_frames=1500, read_ahead=250, prebuffer=25):
+        self.max_frames = max_frames
+        self.read_ahead = read_ahead
+        self.prebuffer = prebuffer
+        self._streams = {}
+        self._lock = threading.Lock()
+
+        # Totals of the streams that were closed
+        self._underruns = 0
+        self._overruns = 0
+
+    def __len__(self):
+        return len(self._streams)
+
+    def stats(self):
+        "Returns (open streams, underruns, overruns), counted across every stream so far"
+        with self._lock:
+            streams = list(self._streams.values())
+            underruns = self._underruns + sum(s.underruns for s in streams)
+            overruns = self._overruns + sum(s.overruns for s in streams)
+        return len(streams), underruns, overruns
+
+    def open(self, source_input : str, *, gain=None, offset=0, bitrate=128):
+        '''Returns a SharedStreamSource for the input, which is anything ffmpeg can read.
+
+        The stream is PCM, unless a gain is given. Then ffmpeg applies it and encodes
+        the stream to Opus at bitrate (in kbps), and only subscribers at the same gain
+        and bitrate can share it.
+        If offset is given, the stream starts that many seconds in.
+        '''
+        key = source_input
+        if gain is not None or offset:
+            key = (source_input, gain and round(gain, 3), round(offset, 2), bitrate)
+        with self._lock:
+            stream = self._streams.get(key)
+            subscriber = stream and stream.subscribe()
+            if subscriber:
+                return subscriber
+
+            if gain is None:
+                before_options = '-ss {:.2f}'.format(offset) if offset else None
+                source = discord.FFmpegPCMAudio(source_input, before_options=before_options)
+            else:
+                source = FFmpegOpusSource(source_input, gain=gain, offset=offset, bitrate=bitrate)
+            stream = SharedStream(
+                self, key, source,
+                max_frames=self.max_frames,
+                read_ahead=self.read_ahead,
+                prebuffer=self.prebuffer)
+            self._streams[key] = stream
+            return stream.subscribe()
+
+    def _remove(self, stream):
+        with self._lock:
+            if self._streams.get(stream.key) is stream:
+                del self._streams[stream.key]
+            self._underruns += stream.underruns
+            self._overruns += stream.overruns
+        if stream.underruns or stream.overruns:
+            logging.info('Shared stream %s had %d underruns and %d overruns',
+                stream.key, stream.underruns, stream.overruns)
@@ -1,13 +1,33 @@
+import time
 import discord
 
+from .songcache import source_expiry
+
 class Song:
     '''Represents a song data object
-    
+
     Encapsulates the title, url, and raw source of a "song",
-    which can be a video or a normal audio file
+    which can be a video or a normal audio file. The duration
+    is in seconds and the loudness in LUFS, both are None if unknown.
+
+    The source may be None for songs that were queued from a flat playlist,
+    these have to be resolved by the Loader before playing.
     '''
 
-    def __init__(self, title : str, url, source):
+    # Playlists can hold many thousands of these
+    __slots__ = ('title', 'url', 'source', 'duration', 'loudness')
+
+    def __init__(self, title : str, url, source=None, duration=None):
         self.title = title
         self.url = url
-        self.source = source
\ No newline at end of file
+        self.source = source
+        self.duration = duration
+        self.loudness = None
+
+    def is_stale(self, margin=0):
+        '''Returns true if the source is missing or its stream url expires within margin seconds.
+        Sources without a known expiration are never considered stale'''
+        if not self.source:
+            return True
+        expires = source_expiry(self.source, None)
+        return expires is not None and time.time() + margin >= expires
@@ -0,0 +1,207 @@
+import asyncio
+import collections
+import json
+import os
+import time
+import logging
+from urllib.parse import urlsplit, parse_qs
+
+from core.filelock import locked
+
+def normalize_lookup(lookup : str):
+    '''Returns a cache key for a lookup string.
+
+    Whitespace and fragments are dropped, the scheme and host are lowercased,
+    and the various youtube link formats collapse to a single watch url.
+    '''
+    lookup = lookup.strip()
+    parts = urlsplit(lookup)
+    if not parts.scheme or not parts.netloc:
+        return lookup
+
+    host = parts.netloc.lower()
+    if host.startswith('www.') or host.startswith('m.'):
+        host = host.split('.', 1)[1]
+
+    video_id = None
+    if host == 'youtu.be':
+        video_id = parts.path.strip('/')
+    elif host == 'youtube.com' and parts.path == '/watch':
+        video_id = parse_qs(parts.query).get('v', [None])[0]
+    if video_id:
+        return 'https://www.youtube.com/watch?v=' + video_id
+
+    url = '{}://{}{}'.format(parts.scheme.lower(), parts.netloc.lower(), parts.path)
+    if parts.query:
+        url += '?' + parts.query
+    return url
+
+def source_expiry(source : str, default_ttl):
+    '''Returns the unix time the stream url stops being valid.
+
+    Signed stream urls (like googlevideo ones) carry an expire parameter,
+    anything else is assumed to last default_ttl seconds. If default_ttl is
+    None, returns None for those.
+    '''
+    query = parse_qs(urlsplit(source).query)
+    try:
+        return int(query['expire'][0])
+    except (KeyError, IndexError, ValueError):
+        if default_ttl is None:
+            return None
+        return int(time.time() + default_ttl)
+
+class SongCacheEntry:
+    "A cached extraction result. The source is only usable until expires."
+
+    def __init__(self, title, url, source, expires, duration=None):
+        self.title = title
+        self.url = url
+        self.source = source
+        self.expires = expires
+        self.duration = duration
+
+    def is_fresh(self, margin=0):
+        "Returns true if the stream url will still be valid after margin seconds"
+        return time.time() + margin < self.expires
+
+class SongCache:
+    '''A LRU bounded cache of extraction results that persists to disk.
+
+    Entries are keyed by normalize_lookup. Entries outlive their stream url,
+    so a stale entry still has a valid title and page url to re-resolve from.
+    Saving merges in what other processes (shards) saved, so they share entries.
+    Changes are saved save_interval seconds after they're made, in the background.
+    '''
+
+    save_interval = 10
+
+    def __init__(self, path, *, max_entries=500, default_ttl=3600, margin=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.margin = margin
+        self._entries = collections.OrderedDict()
+        self._dirty = False
+        self._save_handle = None
+        self._saving = None
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, lookup : str):
+        '''Returns the SongCacheEntry for the lookup, or None.
+        The entry may be stale, check it with is_fresh(cache.margin)'''
+        key = normalize_lookup(lookup)
+        entry = self._entries.get(key)
+        if entry:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, lookup : str, title, url, source, duration=None):
+        "Stores an extraction result. Its written to disk later, in the background"
+        key = normalize_lookup(lookup)
+        expires = source_expiry(source, self.default_ttl)
+        self._entries[key] = SongCacheEntry(title, url, source, expires, duration)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._dirty = True
+        self._schedule_save()
+
+    def save(self):
+        "Writes unsaved changes to disk now, like before shutting down"
+        if self._save_handle:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if self._dirty:
+            self._dirty = False
+            self._merge(self._write(list(self._entries.items())))
+
+    def invalidate(self, lookup : str):
+        '''Marks the entry's stream url as expired, keeping the metadata'''
+        entry = self._entries.get(normalize_lookup(lookup))
+        if entry:
+            entry.expires = 0
+
+    def _load(self):
+        self._entries = self._read()
+
+    def _read(self):
+        "Returns the entries saved on disk"
+        entries = collections.OrderedDict()
+        try:
+            with open(self.path, encoding='utf8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return entries
+        except (OSError, ValueError):
+            logging.exception('Could not read song cache at %s', self.path)
+            return entries
+
+        for key, values in data[-self.max_entries:]:
+            entries[key] = SongCacheEntry(*values)
+        return entries
+
+    def _save_later(self):
+        self._save_handle = None
+        if self._saving:
+            # Tried again later, so that only one save runs at a time
+            self._schedule_save()
+            return
+        self._dirty = False
+        self._saving = asyncio.ensure_future(self._save_in_background(list(self._entries.items())))
+
+    def _schedule_save(self):
+        if not self._save_handle:
+            loop = asyncio.get_event_loop()
+            self._save_handle = loop.call_later(self.save_interval, self._save_later)
+
+    async def _save_in_background(self, entries):
+        "This is a coroutine. Writes a snapshot of the entries on another thread, and merges in what others saved"
+        try:
+            loop = asyncio.get_event_loop()
+            self._merge(await loop.run_in_executor(None, self._write, entries))
+        except Exception:
+            logging.exception('Could not save song cache at %s', self.path)
+        finally:
+            self._saving = None
+
+    def _merge(self, saved):
+        "Takes in the entries other processes saved. Entries not used here count as the least recently used"
+        for key in reversed(saved):
+            entry = saved[key]
+            mine = self._entries.get(key)
+            if mine is None:
+                self._entries[key] = entry
+                self._entries.move_to_end(key, last=False)
+            elif entry.expires > mine.expires:
+                self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _write(self, entries):
+        "Writes the (key, entry) pairs merged with what's on disk, and returns the merged entries"
+        with locked(self.path):
+            # Entries saved by other processes are kept, but ours count as more recently used
+            saved = self._read()
+            for key, entry in entries:
+                other = saved.pop(key, None)
+                if other and other.expires > entry.expires:
+                    entry = other
+                saved[key] = entry
+            while len(saved) > self.max_entries:
+                saved.popitem(last=False)
+            entries = saved
+
+            # Oldest first so that reloading preserves the LRU order
+            data = [[key, [e.title, e.url, e.source, e.expires, e.duration]] for key, e in entries.items()]
+            temp_path = self.path + '.tmp'
+            try:
+                with open(temp_path, 'w', encoding='utf8') as f:
+                    json.dump(data, f)
+                os.replace(temp_path, self.path)
+            except OSError:
+                logging.exception('Could not write song cache at %s', self.path)
+            return entries
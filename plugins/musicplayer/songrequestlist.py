@@ -1,28 +1,199 @@
-import collections
+import array
+import itertools
 import random
 
+class _IndexBlocks:
+    '''A sequence of unique unsigned ints (table indices), stored as blocks of arrays.
+
+    Inserting or removing only shifts the items of one block, and the block
+    holding a position is found in O(log n) through a Fenwick tree of block
+    lengths.
+    '''
+
+    load = 512
+
+    def __init__(self, items=()):
+        self.reset(items)
+
+    def reset(self, items):
+        "Replaces the contents with items"
+        self._blocks = []
+        self._len = 0
+
+        items = array.array('I', items)
+        for start in range(0, len(items), self.load):
+            self._new_block(len(self._blocks), items[start:start + self.load])
+        self._rebuild_tree()
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for block in self._blocks:
+            yield from block
+
+    def __getitem__(self, position):
+        ordinal, offset = self._locate(self._check(position))
+        return self._blocks[ordinal][offset]
+
+    def __setitem__(self, position, item):
+        ordinal, offset = self._locate(self._check(position))
+        self._blocks[ordinal][offset] = item
+
+    def window(self, start, count):
+        "Yields up to count items starting at position start"
+        ordinal, offset = self._locate(max(0, start))
+        while count > 0 and ordinal < len(self._blocks):
+            chunk = self._blocks[ordinal][offset:offset + count]
+            yield from chunk
+            count -= len(chunk)
+            ordinal += 1
+            offset = 0
+
+    def append(self, item):
+        self.insert(self._len, item)
+
+    def extend(self, items):
+        items = array.array('I', items)
+        start = 0
+        if self._blocks:
+            last = self._blocks[-1]
+            start = max(0, self.load - len(last))
+            chunk = items[:start]
+            last.extend(chunk)
+            self._len += len(chunk)
+        for start in range(start, len(items), self.load):
+            self._new_block(len(self._blocks), items[start:start + self.load])
+        self._rebuild_tree()
+
+    def insert(self, position, item):
+        "Inserts item before position, which can be the length to append"
+        if not 0 <= position <= self._len:
+            raise IndexError('position out of range')
+        if not self._blocks:
+            self._new_block(0, array.array('I', (item,)))
+            self._rebuild_tree()
+            return
+
+        ordinal, offset = self._locate(position)
+        if ordinal == len(self._blocks):
+            ordinal -= 1
+            offset = len(self._blocks[ordinal])
+
+        block = self._blocks[ordinal]
+        block.insert(offset, item)
+        self._len += 1
+        self._add(ordinal, 1)
+
+        # Blocks are split once they're twice their load, so shifting stays cheap
+        if len(block) > 2 * self.load:
+            half = block[self.load:]
+            del block[self.load:]
+            self._len -= len(half)
+            self._new_block(ordinal + 1, half)
+            self._rebuild_tree()
+
+    def pop(self, position):
+        "Removes and returns the item at position"
+        ordinal, offset = self._locate(self._check(position))
+        block = self._blocks[ordinal]
+        item = block.pop(offset)
+        self._len -= 1
+        if block:
+            self._add(ordinal, -1)
+        else:
+            del self._blocks[ordinal]
+            self._rebuild_tree()
+        return item
+
+    def _check(self, position):
+        if position < 0:
+            position += self._len
+        if not 0 <= position < self._len:
+            raise IndexError('position out of range')
+        return position
+
+    def _new_block(self, ordinal, items):
+        self._blocks.insert(ordinal, items)
+        self._len += len(items)
+
+    def _rebuild_tree(self):
+        tree = [0]
+        tree.extend(len(block) for block in self._blocks)
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _add(self, ordinal, delta):
+        tree = self._tree
+        i = ordinal + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _locate(self, position):
+        '''Returns (ordinal, offset) of the block holding position.
+        Past the end this returns the number of blocks as the ordinal'''
+        tree = self._tree
+        count = len(tree) - 1
+        ordinal = 0
+        step = 1 << count.bit_length() >> 1
+        while step:
+            following = ordinal + step
+            if following <= count and tree[following] <= position:
+                ordinal = following
+                position -= tree[following]
+            step >>= 1
+        return ordinal, position
+
 class SongRequestList:
-    "Represents a queue of songs that can be manipulated"
+    '''Represents a queue of songs that can be manipulated
+
+    Every request is stored once, in the order it was added. The play order
+    is a sequence of indices into those, with a position marking the next one.
+    Restarting a loop only resets the position, and shuffling picks each next
+    index randomly from the ones left in the cycle (a lazy Fisher-Yates), so
+    neither copies the list.
+
+    Positions given to the queue manipulation methods count from the next
+    song (0). Using them while shuffling fixes the shuffled order for the
+    rest of the cycle, as a position needs a song to refer to.
+    '''
+
+    # Removed requests leave a hole in the table until there are this many
+    compact_after = 1024
 
     def __init__(self):
         self.shuffle = False
         self.loop = False
 
-        # Contain the list of songs and upcoming songs.
-        # The original list is kept to support looping (aka reloading)
         self.current = None
         self.songs = []
-        self.song_queue = collections.deque()
+        self._removed = 0
+        self._order = _IndexBlocks()
+        self._position = 0
+
+        # Whether the index at _position was already picked randomly by peek()
+        self._picked = False
+        # Whether the rest of the cycle was already shuffled, so nothing has to be picked
+        self._settled = False
 
     def add(self, song):
         "Adds a single song request to the queue"
+        self._insert_index(len(self.songs))
         self.songs.append(song)
-        self.song_queue.append(song)
 
     def extend(self, songs):
         "Adds multiple song requests to the queue"
+        start = len(self.songs)
         self.songs.extend(songs)
-        self.song_queue.extend(songs)
+        if self.shuffle and self._settled:
+            for index in range(start, len(self.songs)):
+                self._insert_index(index)
+        else:
+            self._order.extend(range(start, len(self.songs)))
 
     def reset(self, songs, *, loop=False, shuffle=False):
         self.clear()
@@ -33,21 +204,114 @@ class SongRequestList:
 
     def clear(self):
         self.songs.clear()
-        self.song_queue.clear()
+        self._removed = 0
+        self._order.reset(())
+        self._position = 0
+        self._picked = False
+        self._settled = False
 
     def shuffle_queue(self):
         'Randomizes the upcoming songs and enables shuffling'
         self.shuffle = True
-        shuffled_items = list(self.song_queue)
-        random.shuffle(shuffled_items)
-        self.song_queue.clear()
-        self.song_queue.extend(shuffled_items)
+        self._settled = False
 
     def __len__(self):
-        return len(self.songs)
+        return len(self.songs) - self._removed
 
     def __iter__(self):
-        return self.songs.__iter__()
+        return (song for song in self.songs if song is not None)
+
+    @property
+    def upcoming(self):
+        "Returns how many songs are left before the queue ends or loops"
+        return len(self._order) - self._position
+
+    def window(self, start, count):
+        "Returns up to count upcoming songs, starting at position start"
+        self._settle()
+        indices = self._order.window(self._position + start, count)
+        return [self.songs[i] for i in indices]
+
+    def find(self, predicate):
+        "Returns the position of the first upcoming song that matches predicate, or None"
+        self._settle()
+        upcoming = self._order.window(self._position, self.upcoming)
+        for position, index in enumerate(upcoming):
+            if predicate(self.songs[index]):
+                return position
+        return None
+
+    def remove_at(self, position):
+        "Removes the upcoming song at position and returns it"
+        self._settle()
+        index = self._order.pop(self._position + self._check(position))
+        song = self.songs[index]
+        self.songs[index] = None
+        self._removed += 1
+        if self._removed >= self.compact_after and self._removed > len(self):
+            self._compact()
+        return song
+
+    def move(self, position, new_position):
+        "Moves the upcoming song at position to new_position"
+        self._settle()
+        index = self._order.pop(self._position + self._check(position))
+        self._order.insert(self._position + min(max(new_position, 0), self.upcoming), index)
+
+    def jump_to(self, position):
+        "Makes the upcoming song at position the next one and returns it"
+        self.move(position, 0)
+        return self.songs[self._order[self._position]]
+
+    def remove_where(self, predicate):
+        "Removes every song that matches predicate, played or not. Returns how many were removed"
+        removed = 0
+        for index, song in enumerate(self.songs):
+            if song is not None and predicate(song):
+                self.songs[index] = None
+                removed += 1
+        if removed:
+            self._removed += removed
+            self._compact()
+        return removed
+
+    def remove_by_user(self, user):
+        "Removes every song requested by user. Returns how many were removed"
+        return self.remove_where(lambda song: song.request_user.id == user.id)
+
+    def dedupe(self):
+        '''Removes songs with the same url as another, keeping the one that plays first.
+        Returns how many were removed'''
+        seen = set()
+        if self.current:
+            seen.add(self.current.url)
+
+        removed = 0
+        # Upcoming songs come first, then the ones that would play again after looping
+        order = itertools.chain(
+            self._order.window(self._position, self.upcoming),
+            self._order.window(0, self._position))
+        for index in order:
+            song = self.songs[index]
+            if song is self.current:
+                continue
+            if song.url in seen:
+                self.songs[index] = None
+                removed += 1
+            else:
+                seen.add(song.url)
+        if removed:
+            self._removed += removed
+            self._compact()
+        return removed
+
+    def peek(self):
+        '''Returns the song that next() will return without advancing, or None if unknown.
+        When a loop restarts the order isn't decided yet, so this returns None there'''
+        if self._position >= len(self._order):
+            return None
+        self._pick()
+        return self.songs[self._order[self._position]]
 
     def next(self):
         '''Returns the next song, or None if there are no more.
@@ -56,24 +320,87 @@ class SongRequestList:
         If there is more than one item and both options are enabled, next()
         will avoid re-playing the last played song.
         '''
-        try:
-            self.current = self.song_queue.popleft()
-            return self.current
-        except IndexError:
-            if not self.loop or not self.songs:
+        if self._position >= len(self._order):
+            if not self.loop or not len(self._order):
                 return None
 
-            # looping is on, so recreate the list
-            new_queue = list(self.songs)
+            # looping is on, so restart the cycle
+            self._position = 0
+            self._picked = False
+            self._settled = False
+            self._pick(avoid=self.current)
+
+        self._pick()
+        self.current = self.songs[self._order[self._position]]
+        self._position += 1
+        self._picked = False
+        return self.current
+
+    def _check(self, position):
+        if not 0 <= position < self.upcoming:
+            raise IndexError('position out of range')
+        return position
+
+    def _insert_index(self, index):
+        "Queues a table index, at a random upcoming position if the shuffled order is already fixed"
+        if self.shuffle and self._settled:
+            self._order.insert(random.randint(self._position, len(self._order)), index)
+        else:
+            self._order.append(index)
+
+    def _pick(self, avoid=None):
+        "When shuffling, swaps a random upcoming index into the next position"
+        if not self.shuffle or self._picked or self._settled:
+            return
+
+        order = self._order
+        position = self._position
+        idx = random.randrange(position, len(order))
+
+        # prevent double play, by picking again from everything but that one
+        if avoid is not None and self.songs[order[idx]] is avoid and len(order) - position > 1:
+            other = random.randrange(position, len(order) - 1)
+            idx = other + 1 if other >= idx else other
+
+        order[position], order[idx] = order[idx], order[position]
+        self._picked = True
+
+    def _settle(self):
+        "When shuffling, shuffles the rest of the cycle at once so that positions mean something"
+        if not self.shuffle or self._settled:
+            return
+
+        # An index already picked by peek() stays next
+        start = self._position + (1 if self._picked else 0)
+        order = list(self._order)
+        rest = order[start:]
+        random.shuffle(rest)
+        order[start:] = rest
+        self._order.reset(order)
+        self._settled = True
 
-            # shuffle
-            if self.shuffle and len(new_queue) > 1:
-                random.shuffle(new_queue)
+    def _compact(self):
+        "Drops removed songs from the table, and their indices from the play order"
+        remap = array.array('l')
+        songs = []
+        for song in self.songs:
+            remap.append(len(songs) if song is not None else -1)
+            if song is not None:
+                songs.append(song)
 
-                # prevent double play
-                if new_queue[0] == self.current:
-                    idx = random.randint(1, len(new_queue) - 1)
-                    new_queue[0], new_queue[idx] = new_queue[idx], new_queue[0]
+        order = []
+        position = 0
+        for i, index in enumerate(self._order):
+            index = remap[index]
+            if index < 0:
+                if i == self._position:
+                    self._picked = False
+                continue
+            if i < self._position:
+                position += 1
+            order.append(index)
 
-            self.song_queue.extend(new_queue)
-            return self.next()
+        self.songs = songs
+        self._removed = 0
+        self._order.reset(order)
+        self._position = position
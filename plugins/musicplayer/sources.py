@@ -0,0 +1,134 @@
+import itertools
+import subprocess
+
+import discord
+
+def iter_ogg_packets(file):
+    '''Yields the audio packets of an Ogg Opus file object.
+    The Opus header packets are skipped'''
+    partial = b''
+    while True:
+        header = file.read(27)
+        if len(header) < 27 or header[:4] != b'OggS':
+            return
+
+        # A packet is split in segments of 255, and ends at the first shorter one
+        lacing = file.read(header[26])
+        data = file.read(sum(lacing))
+        offset = 0
+        for size in lacing:
+            partial += data[offset:offset + size]
+            offset += size
+            if size < 255:
+                # The first two packets are headers, not audio
+                if not partial.startswith((b'OpusHead', b'OpusTags')):
+                    yield partial
+                partial = b''
+
+class TrackedSource(discord.AudioSource):
+    '''Wraps an AudioSource, counting the frames read from it.
+    Each frame is 20ms of audio. Silence played in place of frames that weren't
+    decoded in time, which sources like SharedStreamSource count as underruns, isn't counted'''
+
+    def __init__(self, original : discord.AudioSource):
+        self.original = original
+        self._reads = 0
+
+    @property
+    def frames(self):
+        "How many frames of the original were played"
+        return self._reads - getattr(self.original, 'underruns', 0)
+
+    def read(self):
+        data = self.original.read()
+        if data:
+            self._reads += 1
+        return data
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+class OggOpusSource(discord.AudioSource):
+    '''Plays an Ogg Opus file by sending its packets as they are, without ffmpeg or encoding.
+
+    The file must use 20ms frames, which is what the ClipCache writes.
+    Volume can't be applied to it. Playback starts at frame start.
+    '''
+
+    def __init__(self, path, start=0):
+        self._file = open(path, 'rb')
+        self._packets = itertools.islice(iter_ogg_packets(self._file), start, None)
+
+    def read(self):
+        return next(self._packets, b'')
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+class FFmpegOpusSource(discord.AudioSource):
+    '''Decodes an input, applies gain and encodes it to Opus in an ffmpeg process.
+
+    The encoded packets are read back from its output as Ogg, so the bot process
+    neither decodes nor encodes, and separate ffmpeg processes spread across cores.
+    Gain is fixed when it starts. Playback starts offset seconds in.
+    '''
+
+    def __init__(self, input, *, gain=1.0, bitrate=128, offset=0):
+        self._process = subprocess.Popen([
+            'ffmpeg', '-nostdin', '-loglevel', 'error',
+            '-ss', '{:.2f}'.format(offset),
+            '-i', input, '-vn',
+            '-af', 'volume={:.4f}'.format(gain),
+            '-ar', '48000', '-ac', '2',
+            '-c:a', 'libopus', '-b:a', '{}k'.format(bitrate), '-frame_duration', '20',
+            # Short pages, so that packets don't wait a second to be written
+            '-page_duration', '100000',
+            '-f', 'ogg', 'pipe:1'
+        ], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        self._packets = iter_ogg_packets(self._process.stdout)
+
+    def read(self):
+        return next(self._packets, b'')
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        process = self._process
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
+class MemoryAudioSource(discord.AudioSource):
+    '''Plays a MemoryClip, starting at frame start. Opus packets are handed out as memoryview
+    slices of the clip's data, so any number of these can play the same clip without copying it.
+    PCM frames are copied, as the Opus encoder only takes bytes'''
+
+    def __init__(self, clip, start=0):
+        self.clip = clip
+        self._view = memoryview(clip.data)
+        self._index = start
+
+    def read(self):
+        if self._index >= len(self.clip):
+            return b''
+        start, end = self.clip.bounds(self._index)
+        self._index += 1
+        if self.clip.is_opus:
+            # The voice client makes bytes of packets itself
+            return self._view[start:end]
+        return self.clip.data[start:end]
+
+    def is_opus(self):
+        return self.clip.is_opus
+
+    def cleanup(self):
+        # The view isn't released, as frames handed out may still be in use
+        self._index = len(self.clip)
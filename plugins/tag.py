@@ -1,7 +1,14 @@
+import asyncio
+import os
 import shelve
+import time
 import traceback
+import discord
 from discord.ext import commands
-from core import InvalidTagException
+from core import InvalidTagException, TagScope, checks, tagio
+
+# Exports larger than this are left on disk instead of uploaded
+MAX_UPLOAD_SIZE = 8 * 1024 * 1024
 
 class TagPlugin(commands.Cog):
     def __init__(self, bot, tagdb):
@@ -11,23 +18,30 @@ class TagPlugin(commands.Cog):
     @commands.command(name='addtag',
         help="Adds a tag as a user tag, which can only be used by you")
     async def addtag_cmd(self, ctx, name, *, content):
-        try:
-            self.tagdb.set(ctx.message.author.id, name, content.strip())
-            await ctx.send('tag added')
-        except InvalidTagException:
-            await ctx.send('Invalid tag name')
-        except Exception:
-            traceback.print_exc()
-            await ctx.send('Unknown error')
+        await self._add_tag(ctx, TagScope.USER, ctx.message.author.id, name, content)
+
+    @commands.command(name='addguildtag',
+        help="Adds a tag as a guild tag, which can be used by everyone in this guild")
+    @commands.guild_only()
+    @commands.check(checks.is_owner_or_admin)
+    async def addguildtag_cmd(self, ctx, name, *, content):
+        await self._add_tag(ctx, TagScope.GUILD, ctx.guild.id, name, content)
+
+    @commands.command(name='addglobaltag',
+        help="Adds a tag as a global tag, which can be used by everyone")
+    @commands.is_owner()
+    async def addglobaltag_cmd(self, ctx, name, *, content):
+        await self._add_tag(ctx, TagScope.GLOBAL, 0, name, content)
 
     @commands.command(name='tag',
-        help="Display a user tag")
+        help="Display a tag. Your tags are looked at first, then the guild's, then global ones")
     async def tag_cmd(self, ctx, name):
+        guild_id = ctx.guild.id if ctx.guild else None
         try:
-            value = self.tagdb.get(ctx.message.author.id, name)
+            value = await self.tagdb.resolve(ctx.message.author.id, guild_id, name)
             await ctx.send(value)
         except KeyError:
-            await ctx.send('Tag {} does not exist'.format(name))
+            await ctx.send(await self._missing_tag_message(ctx.message.author.id, guild_id, name))
         except InvalidTagException:
             await ctx.send('Invalid tag name')
         except Exception:
@@ -35,14 +49,91 @@ class TagPlugin(commands.Cog):
             await ctx.send('Unknown error')
 
     @commands.command(name='taglist',
-        help="Displays all your user tags")
+        help="Displays all your user tags, and this guild's tags")
     async def taglist_cmd(self, ctx):
         try:
-            keys = self.tagdb.keys_for(ctx.message.author.id)
+            keys = await self.tagdb.keys_for(ctx.message.author.id)
             if keys:
-                await ctx.send('Your tag names are: {}'.format(', '.join(keys)))
+                message = 'Your tag names are: {}'.format(', '.join(keys))
             else:
-                await ctx.send("You don't have any tags")
+                message = "You don't have any tags"
+            if ctx.guild:
+                guild_keys = await self.tagdb.names(TagScope.GUILD, ctx.guild.id)
+                if guild_keys:
+                    message += "\nThis guild's tag names are: {}".format(', '.join(guild_keys))
+            await ctx.send(message)
         except:
             traceback.print_exc()
             await ctx.send('Unknown error')
+
+    @commands.is_owner()
+    @commands.command(name='exporttags')
+    async def exporttags_cmd(self, ctx):
+        "Exports every tag as JSON Lines, while the bot keeps running"
+        path = os.path.join('database', 'tags-{}.jsonl'.format(time.strftime('%Y%m%d-%H%M%S')))
+        try:
+            count = await self._in_executor(self._export, path)
+        except Exception:
+            traceback.print_exc()
+            await ctx.send('Unknown error')
+            return
+
+        if os.path.getsize(path) <= MAX_UPLOAD_SIZE:
+            await ctx.send('Exported {} tags'.format(count), file=discord.File(path))
+        else:
+            await ctx.send('Exported {} tags to {}'.format(count, path))
+
+    @commands.is_owner()
+    @commands.command(name='importtags')
+    async def importtags_cmd(self, ctx, path=None, overwrite: bool=True):
+        '''Imports tags from a JSON Lines file, attached or at a path on the bot's host.
+        Existing tags are overwritten unless overwrite is no'''
+        if ctx.message.attachments:
+            path = os.path.join('database', 'tags-import.jsonl')
+            await ctx.message.attachments[0].save(path)
+        elif not path:
+            await ctx.send('Attach a file or give the path of one')
+            return
+
+        try:
+            written, skipped = await self._in_executor(self._import, path, overwrite)
+        except FileNotFoundError:
+            await ctx.send('There is no file {}'.format(path))
+            return
+        except Exception:
+            traceback.print_exc()
+            await ctx.send('Unknown error')
+            return
+        await ctx.send('Imported {} tags, skipped {} invalid lines'.format(written, skipped))
+
+    async def _add_tag(self, ctx, scope, owner_id, name, content):
+        try:
+            await self.tagdb.set_scoped(scope, owner_id, name, content.strip())
+            await ctx.send('tag added')
+        except InvalidTagException:
+            await ctx.send('Invalid tag name')
+        except Exception:
+            traceback.print_exc()
+            await ctx.send('Unknown error')
+
+    async def _missing_tag_message(self, user_id, guild_id, name):
+        "Suggests tags that start with the name, or look like it"
+        completions = await self.tagdb.complete(user_id, guild_id, name)
+        if completions:
+            return 'Tag {} does not exist. Tags starting with it: {}'.format(name, ', '.join(completions))
+        suggestions = await self.tagdb.suggest(user_id, guild_id, name)
+        if suggestions:
+            return 'Tag {} does not exist. Did you mean: {}?'.format(name, ', '.join(suggestions))
+        return 'Tag {} does not exist'.format(name)
+
+    async def _in_executor(self, fn, *args):
+        # Runs beside the database's own thread, as the export and import only hold it a batch at a time
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    def _export(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            return tagio.export_tags(self.tagdb.db.iter_tags(), f)
+
+    def _import(self, path, overwrite):
+        with open(path, encoding='utf-8') as f:
+            return tagio.import_tags(self.tagdb.db, f, overwrite=overwrite)
@@ -2,52 +2,176 @@ import collections
 import asyncio
 
 class AsyncDeque:
-    def __init__(self, loop=None):
+    '''A deque whose pops wait for items, and whose puts wait for room.
+
+    maxsize bounds how many items it holds, 0 means no bound. The deque methods
+    (append, extend...) never wait, and raise asyncio.QueueFull if there isn't room.
+    put and put_many wait for room instead, and pop, popleft and get_many wait for items.
+    The waits take an optional timeout in seconds, after which asyncio.TimeoutError is raised.
+
+    Waiters are woken in the order they started waiting, as many as there are items
+    (or room) for. A waiter that is cancelled after being woken passes it on to the next,
+    so an item is never left behind while someone waits for it.
+    '''
+
+    def __init__(self, maxsize=0, *, loop=None):
+        self.maxsize = maxsize
+        self._loop = loop
         self._queue = collections.deque()
         self._getters = collections.deque()
+        self._putters = collections.deque()
 
     def __len__(self):
         return len(self._queue)
 
     def __iter__(self):
         return list(self._queue).__iter__()
-        
-    def _wake_next(self):
-        while self._getters:
-            future = self._getters.pop()
-            if not future.done():
-                future.set_result(None)
-                break
+
+    def full(self):
+        return 0 < self.maxsize <= len(self._queue)
+
+    def room(self):
+        "How many items can be added without waiting, None if there is no bound"
+        if self.maxsize <= 0:
+            return None
+        return max(0, self.maxsize - len(self._queue))
 
     def append(self, x):
+        if self.full():
+            raise asyncio.QueueFull()
         self._queue.append(x)
-        self._wake_next()
+        if self._getters:
+            self._wake(self._getters, 1)
 
     def appendleft(self, x):
+        if self.full():
+            raise asyncio.QueueFull()
         self._queue.appendleft(x)
-        self._wake_next()
+        if self._getters:
+            self._wake(self._getters, 1)
 
     def extend(self, iterable):
-        for x in iterable:
-            self.append(x)
+        "Appends every item, waking the waiting getters once. Nothing is added if they don't all fit"
+        items = list(iterable)
+        self._check_room(len(items))
+        self._queue.extend(items)
+        self._wake(self._getters, len(items))
 
     def extendleft(self, iterable):
-        for x in iterable:
-            self.appendleft(x)
+        "Appends every item to the left, waking the waiting getters once. Nothing is added if they don't all fit"
+        items = list(iterable)
+        self._check_room(len(items))
+        self._queue.extendleft(items)
+        self._wake(self._getters, len(items))
 
     def clear(self):
+        count = len(self._queue)
         self._queue.clear()
+        self._wake(self._putters, count)
+
+    def pop_nowait(self):
+        "Removes and returns the rightmost item. Raises asyncio.QueueEmpty if there is none"
+        if not self._queue:
+            raise asyncio.QueueEmpty()
+        item = self._queue.pop()
+        if self._putters:
+            self._wake(self._putters, 1)
+        return item
+
+    def popleft_nowait(self):
+        "Removes and returns the leftmost item. Raises asyncio.QueueEmpty if there is none"
+        if not self._queue:
+            raise asyncio.QueueEmpty()
+        item = self._queue.popleft()
+        if self._putters:
+            self._wake(self._putters, 1)
+        return item
+
+    async def pop(self, *, timeout=None):
+        "This is a coroutine. Removes and returns the rightmost item, waiting for one if needed"
+        if not self._queue:
+            await self._wait(self._getters, self._has_items, timeout)
+        return self.pop_nowait()
+
+    async def popleft(self, *, timeout=None):
+        "This is a coroutine. Removes and returns the leftmost item, waiting for one if needed"
+        if not self._queue:
+            await self._wait(self._getters, self._has_items, timeout)
+        return self.popleft_nowait()
+
+    async def get_many(self, max_items=None, *, timeout=None):
+        '''This is a coroutine. Waits for items, then removes and returns a list of
+        all of them from the left, or max_items of them if given'''
+        await self._wait(self._getters, self._has_items, timeout)
+        count = len(self._queue) if max_items is None else min(max_items, len(self._queue))
+        popleft = self._queue.popleft
+        items = [popleft() for _ in range(count)]
+        self._wake(self._putters, count)
+        # Whoever else was woken may find nothing left, and waits again
+        return items
+
+    async def put(self, x, *, timeout=None):
+        "This is a coroutine. Appends an item, waiting for room if needed"
+        if self.full():
+            await self._wait(self._putters, self._has_room, timeout)
+        self.append(x)
+
+    async def put_many(self, iterable, *, timeout=None):
+        '''This is a coroutine. Appends every item, as many at a time as there is room for.
+        If it times out or is cancelled, the items before that are already added'''
+        items = list(iterable)
+        loop = self._get_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        start = 0
+        while start < len(items):
+            remaining = None if deadline is None else max(0, deadline - loop.time())
+            await self._wait(self._putters, self._has_room, remaining)
+            room = self.room()
+            end = len(items) if room is None else start + room
+            self.extend(items[start:end])
+            start = end
+
+    def _has_items(self):
+        return bool(self._queue)
+
+    def _has_room(self):
+        return not self.full()
+
+    def _check_room(self, count):
+        room = self.room()
+        if room is not None and count > room:
+            raise asyncio.QueueFull()
+
+    def _get_loop(self):
+        return self._loop or asyncio.get_event_loop()
+
+    def _wake(self, waiters, count):
+        while count > 0 and waiters:
+            waiter = waiters.popleft()
+            # Cancelled waiters are still here until their task gets to remove them
+            if not waiter.done():
+                waiter.set_result(None)
+                count -= 1
 
-    async def pop(self):
-        while not self._queue:
-            getter = asyncio.Future()
-            self._getters.appendleft(getter)
-            await getter
-        return self._queue.pop()
-
-    async def popleft(self):
-        while not self._queue:
-            getter = asyncio.Future()
-            self._getters.appendleft(getter)
-            await getter
-        return self._queue.popleft()
+    async def _wait(self, waiters, ready, timeout):
+        "Waits in waiters until ready() is true"
+        loop = self._get_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not ready():
+            waiter = loop.create_future()
+            waiters.append(waiter)
+            try:
+                if deadline is None:
+                    await waiter
+                else:
+                    await asyncio.wait_for(waiter, max(0, deadline - loop.time()))
+            except BaseException:
+                waiter.cancel()
+                try:
+                    waiters.remove(waiter)
+                except ValueError:
+                    # It was woken already, the wake up goes to the next waiter instead
+                    pass
+                if ready():
+                    self._wake(waiters, 1)
+                raise